@@ -0,0 +1,312 @@
+"""Offline benchmark of the pipeline on synthetic consultations.
+
+Runs the real pipeline steps (all but visualization) on generated datasets of
+increasing size, with deterministic local stand-ins for the OpenAI chat and
+embedding models, and reports the wall time, CPU time, peak memory and
+throughput of each step. No network access or API key is needed.
+
+    python benchmark.py --sizes 1000 10000 --latency 0.05 --error-rate 0.01
+
+Each size runs in its own process (so that peak memory is per size), writes
+its input to inputs/benchmark-<size>.csv, its outputs to
+outputs/benchmark-<size>/ (and its log to outputs/benchmark-<size>.log),
+and uses fresh caches so every run is cold.
+For 100k comments and more, use `--method kmeans`: spectral clustering
+builds a dense eigenproblem that does not scale to such sizes.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+import numpy as np
+import pandas as pd
+
+TOPICS = [
+    ['privacy', 'data', 'surveillance', 'consent', 'tracking', 'personal'],
+    ['jobs', 'automation', 'workers', 'unemployment', 'retraining', 'wages'],
+    ['safety', 'testing', 'risk', 'accidents', 'audits', 'standards'],
+    ['education', 'schools', 'students', 'teachers', 'learning', 'cheating'],
+    ['health', 'diagnosis', 'doctors', 'patients', 'hospitals', 'medicine'],
+    ['climate', 'energy', 'emissions', 'datacenters', 'efficiency', 'grid'],
+    ['bias', 'fairness', 'discrimination', 'minorities', 'hiring', 'justice'],
+    ['regulation', 'laws', 'government', 'oversight', 'licenses', 'fines'],
+    ['art', 'copyright', 'artists', 'creativity', 'music', 'royalties'],
+    ['research', 'funding', 'universities', 'open', 'science', 'progress'],
+    ['misinformation', 'elections', 'deepfakes', 'news', 'trust', 'media'],
+    ['military', 'weapons', 'drones', 'warfare', 'treaties', 'defense'],
+]
+FILLERS = ['we', 'should', 'must', 'really', 'need', 'more', 'less', 'about',
+           'the', 'for', 'everyone', 'because', 'of', 'and', 'better', 'rules']
+
+
+def generate_comments(size, seed=42):
+    """A consultation of `size` comments, each mostly about one topic."""
+    rng = np.random.default_rng(seed)
+    topics = rng.integers(len(TOPICS), size=size)
+    lengths = rng.integers(8, 40, size=size)
+    bodies = []
+    for topic, length in zip(topics, lengths):
+        words = np.where(rng.random(length) < 0.5,
+                         rng.choice(TOPICS[topic], size=length),
+                         rng.choice(FILLERS, size=length))
+        bodies.append(' '.join(words).capitalize() + '.')
+    return pd.DataFrame({
+        'comment-id': np.arange(1, size + 1),
+        'comment-body': bodies,
+        'agrees': rng.integers(0, 100, size=size),
+        'disagrees': rng.integers(0, 100, size=size),
+    })
+
+
+class FakeChatOpenAI:
+    """Stand-in for langchain_openai.ChatOpenAI, answering each step's
+    prompts deterministically after a simulated latency. A share
+    `error_rate` of the answers that should be JSON are malformed (fenced,
+    wrapped in text, with a trailing comma or truncated), and a
+    share `throttle_rate` of the calls fail with a 429. Latencies and errors
+    are drawn per call, so that retries and hedged requests can succeed."""
+
+    latency = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+    draws = random.Random(0)
+
+    def __init__(self, model=None, temperature=0.0, **kwargs):
+        self.model = model
+
+    def invoke(self, messages, **kwargs):
+        from langchain_core.messages import AIMessage
+        from metrics import current_step
+        text = messages[-1].content
+        if self.latency > 0:
+            time.sleep(self.draws.expovariate(1 / self.latency))
+        if self.draws.random() < self.throttle_rate:
+            import httpx
+            import openai
+            request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+            raise openai.RateLimitError("Rate limit reached (simulated)", body=None,
+                                        response=httpx.Response(429, request=request))
+        malformed = self.draws.random() < self.error_rate
+        step = current_step.get()
+        if step == 'extraction' and '\n\n{' in text:
+            payload = json.loads(text[text.index('\n\n{') + 2:])
+            answer = json.dumps({id: self.arguments(value) for id, value in payload.items()})
+        elif step == 'extraction' and 'response_format' in kwargs:
+            answer = json.dumps({'arguments': self.arguments(text)})
+        elif step == 'extraction':
+            answer = json.dumps(self.arguments(text))
+        elif step == 'translation' and '\n\n{' in text:
+            payload = json.loads(text[text.index('\n\n{') + 2:])
+            answer = json.dumps({id: f"[tr] {value}" for id, value in payload.items()},
+                                ensure_ascii=False)
+        elif step == 'translation':
+            answer = f"[tr] {text.splitlines()[-1]}"
+        else:
+            answer = f"{step} {zlib.crc32(text.encode()):08x}"
+            malformed = False
+        if malformed:
+            # some defects can be repaired locally, a truncated answer cannot
+            answer = self.draws.choice([
+                f"```json\n{answer}\n```",
+                f"Here are the arguments: {answer}",
+                answer[:-1] + ",\n" + answer[-1:],
+                answer[:len(answer) // 2],
+            ])
+        usage = {'input_tokens': sum(len(m.content) for m in messages) // 4 + 1,
+                 'output_tokens': len(answer) // 4 + 1}
+        usage['total_tokens'] = usage['input_tokens'] + usage['output_tokens']
+        return AIMessage(content=answer, usage_metadata=usage)
+
+    @staticmethod
+    def arguments(comment):
+        words = comment.split()
+        return [' '.join(words[:12]), ' '.join(words[12:24])][:1 + len(words) // 24]
+
+    async def ainvoke(self, messages, **kwargs):
+        return await asyncio.to_thread(self.invoke, messages, **kwargs)
+
+
+class FakeOpenAIEmbeddings:
+    """Stand-in for langchain_openai.OpenAIEmbeddings: random projections of
+    the bag of words, so that texts sharing words get similar vectors."""
+
+    latency = 0.0
+    dimensions = 256
+    buckets = 4096
+
+    def __init__(self, model=None, **kwargs):
+        self.model = model
+        self.projection = np.random.default_rng(0).standard_normal(
+            (self.buckets, self.dimensions)).astype(np.float32)
+
+    def embed_documents(self, texts):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        embeds = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = [zlib.crc32(w.encode()) % self.buckets for w in text.lower().split()]
+            if len(words) > 0:
+                embeds[i] = self.projection[words].sum(axis=0)
+        embeds /= np.maximum(np.linalg.norm(embeds, axis=1, keepdims=True), 1e-9)
+        return embeds.tolist()
+
+
+def run(job_file, args):
+    """Run the pipeline for one job, in this process."""
+    # same numba setup as main.py (steps run in worker threads)
+    os.environ.setdefault('NUMBA_THREADING_LAYER_PRIORITY', 'omp workqueue tbb')
+    import llm
+    import steps.embedding
+    import steps.translation
+    from cache import SqliteCache
+    from steps.extraction import extraction
+    from steps.embedding import embedding
+    from steps.clustering import clustering
+    from steps.labelling import labelling
+    from steps.takeaways import takeaways
+    from steps.overview import overview
+    from steps.translation import translation
+    from steps.aggregation import aggregation
+    from utils import initialization, termination, run_pipeline
+
+    FakeChatOpenAI.latency = args.latency
+    FakeChatOpenAI.error_rate = args.error_rate
+    FakeChatOpenAI.throttle_rate = args.throttle_rate
+    FakeOpenAIEmbeddings.latency = args.latency
+    FakeOpenAIEmbeddings.dimensions = args.dimensions
+    llm.ChatOpenAI = FakeChatOpenAI
+    steps.embedding.OpenAIEmbeddings = FakeOpenAIEmbeddings
+
+    # cold caches, kept away from the ones shared by real jobs
+    cache_dir = tempfile.mkdtemp(prefix='benchmark-cache-')
+    llm.response_cache = SqliteCache(f"{cache_dir}/llm.sqlite", 1024 ** 3)
+    steps.embedding.embedding_cache = SqliteCache(
+        f"{cache_dir}/embeddings.sqlite", 10 * 1024 ** 3)
+    steps.translation.translation_memory = SqliteCache(
+        f"{cache_dir}/translations.sqlite", 1024 ** 3)
+
+    config = initialization([sys.argv[0], job_file, '-f', '-skip-interaction'])
+    try:
+        run_pipeline({
+            'extraction': extraction,
+            'embedding': embedding,
+            'clustering': clustering,
+            'labelling': labelling,
+            'takeaways': takeaways,
+            'overview': overview,
+            'translation': translation,
+            'aggregation': aggregation,
+        }, config)
+        termination(config)
+    except Exception as e:
+        termination(config, error=e)
+
+
+def benchmark(size, args):
+    """Generate the dataset and config for `size` comments, run them in a
+    child process and return the completed jobs from status.json."""
+    name = f"benchmark-{size}"
+    generate_comments(size).to_csv(f"inputs/{name}.csv", index=False)
+    config = {
+        'name': f"Benchmark ({size} comments)",
+        'question': "What should be the priorities for AI development and governance?",
+        'input': name,
+        'cache': False,
+        'extraction': {'limit': size, 'workers': args.workers,
+                       'pack_size': args.pack_size},
+        'embedding': {'concurrency': args.workers},
+        'clustering': {'clusters': args.clusters},
+        'labelling': {'workers': args.workers},
+        'takeaways': {'workers': args.workers},
+        'translation': {'languages': args.languages,
+                        'flags': [language[:2].upper() for language in args.languages],
+                        'workers': args.workers},
+    }
+    if args.method is not None:
+        config['clustering']['method'] = args.method
+    job_file = f"{tempfile.mkdtemp(prefix='benchmark-')}/{name}.json"
+    with open(job_file, 'w') as f:
+        json.dump(config, f)
+
+    command = [sys.executable, __file__, '--job', job_file,
+               '--latency', str(args.latency), '--error-rate', str(args.error_rate),
+               '--throttle-rate', str(args.throttle_rate),
+               '--dimensions', str(args.dimensions)]
+    started = time.monotonic()
+    if args.verbose:
+        subprocess.run(command, check=True)
+    else:
+        with open(f"outputs/{name}.log", 'w') as log:
+            process = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+        if process.returncode != 0:
+            raise Exception(f"Benchmark of {size} comments failed, see outputs/{name}.log")
+    total = time.monotonic() - started
+    with open(f"outputs/{name}/status.json") as f:
+        return total, json.load(f)['completed_jobs']
+
+
+def report(size, total, jobs):
+    print(f"\n{size} comments ({total:.1f}s in total)")
+    print(f"{'step':<12} {'wall s':>9} {'cpu s':>9} {'rss MB':>8} {'rows':>9} "
+          f"{'rows/s':>10} {'requests':>9} {'repairs':>8} {'retries':>8} {'gave up':>8} "
+          f"{'hedged':>7} {'won':>5} {'p95 s':>7}")
+    for job in jobs:
+        metrics = job['metrics']
+        calls = metrics['calls'].values()
+        requests = sum(c['requests'] for c in calls)
+        repairs = sum(c['repairs'] for c in calls)
+        retries = sum(c['retries'] for c in calls)
+        give_ups = sum(c['give_ups'] for c in calls)
+        hedged = sum(c['hedged'] for c in calls)
+        hedge_wins = sum(c['hedge_wins'] for c in calls)
+        p95 = max([c['latency']['p95'] for c in calls if 'latency' in c], default=None)
+        print(f"{job['step']:<12} {job['duration']:>9.2f} {metrics['cpu_time']:>9.2f} "
+              f"{metrics['peak_rss_mb']:>8.0f} {metrics['rows'] or '-':>9} "
+              f"{metrics['rows_per_sec'] or '-':>10} {requests:>9} {repairs:>8} {retries:>8} "
+              f"{give_ups:>8} {hedged:>7} {hedge_wins:>5} {p95 if p95 is not None else '-':>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help="numbers of comments (e.g. 1000 10000 100000 1000000)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="mean simulated latency of each API call, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="share of malformed JSON answers")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="share of calls failing with a 429 (rate limited)")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="concurrent API calls per step")
+    parser.add_argument('--pack-size', type=int, default=1,
+                        help="comments per extraction request")
+    parser.add_argument('--clusters', type=int, default=8)
+    parser.add_argument('--method', default=None,
+                        help="clustering method (default from specs.json)")
+    parser.add_argument('--languages', nargs='*', default=['French'])
+    parser.add_argument('--dimensions', type=int, default=256,
+                        help="size of the fake embeddings")
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the output of the pipeline instead of logging it")
+    parser.add_argument('--job', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    # paths in specs.json and the steps are relative to this folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if args.job is not None:
+        run(args.job, args)
+        return
+    for size in args.sizes:
+        total, jobs = benchmark(size, args)
+        report(size, total, jobs)
+
+
+if __name__ == "__main__":
+    main()
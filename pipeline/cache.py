@@ -0,0 +1,110 @@
+"""Persistent key/value caches shared by the pipeline steps."""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class SqliteCache:
+    """Key/value store in a single SQLite file, capped to `max_bytes` of
+    values and evicting the least recently used entries past the cap."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self.size = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        return self.db
+
+    def get(self, key):
+        with self.lock:
+            db = self.connect()
+            row = db.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            db.execute("UPDATE entries SET last_used = ? WHERE key = ?",
+                       (time.time(), key))
+            return row[0]
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys found in the cache."""
+        keys = list(keys)
+        found = {}
+        with self.lock:
+            db = self.connect()
+            now = time.time()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i: i + 500]
+                marks = ",".join("?" * len(chunk))
+                found.update(db.execute(
+                    f"SELECT key, value FROM entries WHERE key IN ({marks})", chunk))
+                db.execute(
+                    f"UPDATE entries SET last_used = ? WHERE key IN ({marks})",
+                    [now] + chunk)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, key, value):
+        size = len(value.encode() if isinstance(value, str) else value)
+        with self.lock:
+            db = self.connect()
+            old = db.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                       (key, value, size, time.time()))
+            self.size += size - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def delete(self, key):
+        with self.lock:
+            db = self.connect()
+            old = db.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old:
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.size -= old[0]
+
+    def evict(self):
+        # free some headroom so we don't evict again on the very next put
+        target = self.max_bytes * 0.9
+        while self.size > target:
+            rows = self.db.execute(
+                "SELECT key, size FROM entries ORDER BY last_used LIMIT 100").fetchall()
+            if len(rows) == 0:
+                break
+            self.db.executemany(
+                "DELETE FROM entries WHERE key = ?", [(k,) for k, _ in rows])
+            self.size -= sum(size for _, size in rows)
+            self.evictions += len(rows)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size_bytes': self.size,
+        }
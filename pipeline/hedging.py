@@ -0,0 +1,143 @@
+"""Hedged requests: when a call is slower than most recent calls to the same
+model (its p95 latency), a duplicate is sent and the first answer wins.
+
+All prompts run at temperature 0, so either answer is acceptable. The share
+of hedged calls is capped per model, so that hedging never costs more than
+that fraction of extra requests."""
+
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import threading
+import time
+import numpy as np
+from metrics import record_hedge
+
+# latencies needed before hedging, and how many recent ones are kept
+MIN_SAMPLES = 20
+WINDOW = 1000
+# calls are hedged once they take longer than this percentile of latencies,
+# and at least this multiple of the median (so that the jitter of steady
+# latencies does not trigger hedges that cannot win)
+PERCENTILE = 95
+MIN_SLOWDOWN = 1.5
+
+lock = threading.Lock()
+latencies = collections.defaultdict(lambda: collections.deque(maxlen=WINDOW))
+# {model: [calls, hedged calls]}
+counts = collections.defaultdict(lambda: [0, 0])
+# (!) requests run in this pool so that the caller can give up waiting
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=256, thread_name_prefix='hedging')
+
+
+def observe(model, latency):
+    """Record the latency of a successful request."""
+    with lock:
+        latencies[model].append(latency)
+
+
+def deadline(model):
+    """Seconds after which a call to `model` is hedged (None if unknown)."""
+    with lock:
+        if len(latencies[model]) < MIN_SAMPLES:
+            return None
+        median, tail = np.percentile(latencies[model], [50, PERCENTILE])
+    return float(max(tail, MIN_SLOWDOWN * median))
+
+
+def start(model, fraction):
+    """Count a new call, returning its hedging deadline (None for no hedge)."""
+    with lock:
+        counts[model][0] += 1
+    return deadline(model) if fraction > 0 else None
+
+
+def allow(model, fraction, reserve):
+    """The function sending one more request, if it stays within `fraction`
+    of the calls and `reserve()` returns it (None otherwise)."""
+    with lock:
+        calls, hedged = counts[model]
+        if hedged + 1 > fraction * calls:
+            return None
+        send = reserve()
+        if send is not None:
+            counts[model][1] += 1
+        return send
+
+
+def timed(model, func, started):
+    """func(), recording its latency since `started` when it succeeds."""
+    result = func()
+    observe(model, time.monotonic() - started)
+    return result
+
+
+async def atimed(model, func, started):
+    result = await func()
+    observe(model, time.monotonic() - started)
+    return result
+
+
+def submit(model, func):
+    return executor.submit(contextvars.copy_context().run,
+                           timed, model, func, time.monotonic())
+
+
+def call(model, fraction, func, reserve=None):
+    """Return func(), also sending a second request if the first one has not
+    answered by the deadline, whichever succeeds first. `reserve()` returns
+    the function sending the second request (by default func), or None when
+    it may not be sent (e.g. no rate limit slot is free, see ratelimit.call).
+
+    (!) the deadline is measured from here, so func must send its request
+    right away (i.e. after waiting for rate limits, see ratelimit.call)."""
+    limit = start(model, fraction)
+    if limit is None:
+        return timed(model, func, time.monotonic())
+    primary = submit(model, func)
+    try:
+        return primary.result(timeout=limit)
+    except concurrent.futures.TimeoutError:
+        pass
+    second = allow(model, fraction, reserve or (lambda: func))
+    if second is None:
+        return primary.result()
+    hedge = submit(model, second)
+    pending = {primary, hedge}
+    while True:
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        succeeded = [future for future in done if future.exception() is None]
+        if len(succeeded) > 0 or len(pending) == 0:
+            # (!) the other request cannot be cancelled, its answer is dropped
+            winner = (succeeded or list(done))[0]
+            record_hedge('llm', model, won=winner is hedge)
+            return winner.result()
+
+
+async def acall(model, fraction, func, reserve=None):
+    """Same as call() for coroutine functions, cancelling the slower one."""
+    limit = start(model, fraction)
+    if limit is None:
+        return await atimed(model, func, time.monotonic())
+    primary = asyncio.ensure_future(atimed(model, func, time.monotonic()))
+    done, _ = await asyncio.wait({primary}, timeout=limit)
+    if len(done) > 0:
+        return await primary
+    second = allow(model, fraction, reserve or (lambda: func))
+    if second is None:
+        return await primary
+    hedge = asyncio.ensure_future(atimed(model, second, time.monotonic()))
+    pending = {primary, hedge}
+    while True:
+        done, pending = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED)
+        succeeded = [future for future in done if future.exception() is None]
+        if len(succeeded) > 0 or len(pending) == 0:
+            for other in pending:
+                other.cancel()
+            winner = (succeeded or list(done))[0]
+            record_hedge('llm', model, won=winner is hedge)
+            return winner.result()
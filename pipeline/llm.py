@@ -0,0 +1,186 @@
+"""Single entry point for the LLM calls made by the pipeline steps."""
+
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import json
+import threading
+import time
+import httpx
+from langchain_openai import ChatOpenAI
+import ratelimit
+from cache import SqliteCache
+from metrics import record_call, record_cached
+
+# completions are shared by all jobs, so re-running a step (or running
+# another job with the same prompts) never pays twice for the same answer
+response_cache = SqliteCache("outputs/llm_cache.sqlite", max_bytes=1024 ** 3)
+
+
+def cache_key(messages, model, temperature, options=None):
+    """Key of an answer. The request `options` (e.g. response_format) are
+    only part of it when given, so plain calls keep their earlier keys."""
+    request = {
+        'model': model,
+        'temperature': temperature,
+        'messages': [[m.type, m.content] for m in messages],
+    }
+    if options:
+        request['options'] = options
+    payload = json.dumps(request, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# one client per (model, settings) for the whole run, so that all the calls
+# of all the steps share their HTTP connections
+clients = {}
+clients_lock = threading.Lock()
+
+
+def client(model, temperature=0.0, timeout=None, max_connections=None):
+    key = (model, temperature, timeout, max_connections)
+    with clients_lock:
+        if key not in clients:
+            http_clients = {}
+            if max_connections is not None:
+                limits = httpx.Limits(max_connections=max_connections,
+                                      max_keepalive_connections=max_connections)
+                http_clients = {'http_client': httpx.Client(limits=limits),
+                                'http_async_client': httpx.AsyncClient(limits=limits)}
+            # (!) retries are left to ratelimit, which also adapts concurrency
+            clients[key] = ChatOpenAI(model=model, temperature=temperature,
+                                      timeout=timeout, max_retries=0, **http_clients)
+        return clients[key]
+
+
+def request_options(response_format):
+    return {} if response_format is None else {'response_format': response_format}
+
+
+class Gateway:
+    """The LLM calls of a step: model, client settings and caching, with
+    sync, async and batch variants of invoke."""
+
+    def __init__(self, model, temperature=0.0, cache=True, timeout=None,
+                 max_connections=None, hedge_fraction=0.0):
+        self.model = model
+        self.temperature = temperature
+        self.cache = cache
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.hedge_fraction = hedge_fraction
+
+    def client(self):
+        return client(self.model, self.temperature, self.timeout, self.max_connections)
+
+    def cached(self, messages, options):
+        if not self.cache:
+            return None
+        content = response_cache.get(
+            cache_key(messages, self.model, self.temperature, options))
+        if content is not None:
+            record_cached('llm', self.model)
+        return content
+
+    def store(self, messages, options, content):
+        if self.cache:
+            response_cache.put(
+                cache_key(messages, self.model, self.temperature, options), content)
+        return content
+
+    def estimate(self, messages):
+        return sum(token_counts([m.content for m in messages], self.model))
+
+    def done(self, messages, response, started):
+        """Record a request, returning its answer and the tokens it used."""
+        content = response.content
+        usage = getattr(response, 'usage_metadata', None)
+        if usage:
+            prompt_tokens, completion_tokens = usage['input_tokens'], usage['output_tokens']
+        else:
+            prompt_tokens = self.estimate(messages)
+            completion_tokens = token_counts([content], self.model)[0]
+        latency = time.monotonic() - started
+        record_call('llm', self.model, latency, prompt_tokens, completion_tokens)
+        return content, prompt_tokens + completion_tokens
+
+    def request(self, messages, options):
+        started = time.monotonic()
+        return self.done(messages, self.client().invoke(messages, **options), started)
+
+    async def arequest(self, messages, options):
+        started = time.monotonic()
+        return self.done(messages, await self.client().ainvoke(messages, **options), started)
+
+    def invoke(self, messages, response_format=None):
+        """Return the text of the model's answer, reusing cached answers.
+        `response_format` is passed to the API, e.g. {"type": "json_object"}."""
+        options = request_options(response_format)
+        content = self.cached(messages, options)
+        if content is not None:
+            return content
+        estimate = self.estimate(messages)
+        content, _ = ratelimit.call(
+            'llm', self.model, estimate, self.request, messages, options,
+            usage=lambda r: r[1], hedge_fraction=self.hedge_fraction)
+        return self.store(messages, options, content)
+
+    async def ainvoke(self, messages, response_format=None):
+        options = request_options(response_format)
+        content = self.cached(messages, options)
+        if content is not None:
+            return content
+        estimate = self.estimate(messages)
+        content, _ = await ratelimit.acall(
+            'llm', self.model, estimate, self.arequest, messages, options,
+            usage=lambda r: r[1], hedge_fraction=self.hedge_fraction)
+        return self.store(messages, options, content)
+
+    def batch(self, messages_list, workers):
+        """Answers to each list of messages, with `workers` calls in flight."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            # (!) copy the caller's context (e.g. current_step), not the worker's
+            futures = [executor.submit(contextvars.copy_context().run, self.invoke, messages)
+                       for messages in messages_list]
+            return [future.result() for future in futures]
+
+    def forget(self, messages, response_format=None):
+        """Drop a cached answer, e.g. one that turned out to be unusable."""
+        response_cache.delete(cache_key(messages, self.model, self.temperature,
+                                        request_options(response_format)))
+
+
+def gateway(options):
+    """Gateway for an LLM step, from its options in the config."""
+    return Gateway(options['model'], cache=options['cache'],
+                   timeout=options['timeout'],
+                   max_connections=options['max_connections'],
+                   hedge_fraction=options['hedge_fraction'])
+
+
+def cache_stats():
+    return response_cache.stats()
+
+
+@functools.lru_cache(maxsize=None)
+def token_encoding(model):
+    import tiktoken
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads its vocabularies on first use, so on machines
+        # without network access we fall back to an estimate
+        print(f"Warning: could not load tokenizer for '{model}', estimating tokens ({e})")
+        return None
+
+
+def token_counts(texts, model):
+    """Number of tokens in each text, as counted by tiktoken for model."""
+    encoding = token_encoding(model)
+    if encoding is None:
+        return [len(text) // 4 + 1 for text in texts]
+    return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
@@ -3,6 +3,10 @@ import sys
 import json
 from datetime import datetime
 
+# (!) steps now run in worker threads, and numba's TBB threading layer (used
+# by UMAP when installed) hangs at exit after running outside the main thread
+os.environ.setdefault('NUMBA_THREADING_LAYER_PRIORITY', 'omp workqueue tbb')
+
 from steps.embedding import embedding
 from steps.extraction import extraction
 from steps.clustering import clustering
@@ -13,7 +17,7 @@ from steps.aggregation import aggregation
 from steps.visualization import visualization
 from steps.translation import translation
 
-from utils import initialization, termination, run_step
+from utils import initialization, termination, run_pipeline
 
 
 def main():
@@ -21,15 +25,18 @@ def main():
     config = initialization(sys.argv)
 
     try:
-        run_step('extraction', extraction, config)
-        run_step('embedding', embedding, config)
-        run_step('clustering', clustering, config)
-        run_step('labelling', labelling, config)
-        run_step('takeaways', takeaways, config)
-        run_step('overview', overview, config)
-        run_step('translation', translation, config)
-        run_step('aggregation', aggregation, config)
-        run_step('visualization', visualization, config)
+        # steps start as soon as their dependencies in specs.json are done
+        run_pipeline({
+            'extraction': extraction,
+            'embedding': embedding,
+            'clustering': clustering,
+            'labelling': labelling,
+            'takeaways': takeaways,
+            'overview': overview,
+            'translation': translation,
+            'aggregation': aggregation,
+            'visualization': visualization,
+        }, config)
         termination(config)
     except Exception as e:
         termination(config, error=e)
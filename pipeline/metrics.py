@@ -0,0 +1,142 @@
+"""Performance telemetry: resources used by each step and the API calls
+(LLM completions, embeddings) it made."""
+
+import contextvars
+import resource
+import sys
+import threading
+import time
+import numpy as np
+
+# name of the step running in the current thread
+current_step = contextvars.ContextVar('current_step', default=None)
+
+calls_lock = threading.Lock()
+# {step: {"kind:model": call statistics}}
+calls = {}
+
+# seconds between two samples of the memory used by the process
+RSS_INTERVAL = 0.1
+rss_lock = threading.Lock()
+# {step: highest RSS (in MB) sampled while the step was running}
+rss_peaks = {}
+rss_sampler = None
+
+
+def call_stats(kind, model):
+    step = calls.setdefault(current_step.get(), {})
+    return step.setdefault(f"{kind}:{model}", {
+        'requests': 0, 'cached': 0, 'retries': 0, 'repairs': 0, 'give_ups': 0,
+        'hedged': 0, 'hedge_wins': 0,
+        'prompt_tokens': 0, 'completion_tokens': 0, 'latencies': []})
+
+
+def record_call(kind, model, latency, prompt_tokens=0, completion_tokens=0):
+    """Record an API request made by the current step."""
+    with calls_lock:
+        stats = call_stats(kind, model)
+        stats['requests'] += 1
+        stats['prompt_tokens'] += prompt_tokens
+        stats['completion_tokens'] += completion_tokens
+        stats['latencies'].append(latency)
+
+
+def record_cached(kind, model):
+    """Record a call answered from cache, without a request."""
+    with calls_lock:
+        call_stats(kind, model)['cached'] += 1
+
+
+def record_retry(kind, model):
+    """Record a call that had to be made again (e.g. unusable answer)."""
+    with calls_lock:
+        call_stats(kind, model)['retries'] += 1
+
+
+def record_repair(kind, model):
+    """Record an answer that was fixed locally (e.g. malformed JSON)."""
+    with calls_lock:
+        call_stats(kind, model)['repairs'] += 1
+
+
+def record_give_up(kind, model):
+    """Record a call whose answer stayed unusable after all retries."""
+    with calls_lock:
+        call_stats(kind, model)['give_ups'] += 1
+
+
+def record_hedge(kind, model, won):
+    """Record a call that was sent twice, and whether the duplicate won."""
+    with calls_lock:
+        stats = call_stats(kind, model)
+        stats['hedged'] += 1
+        stats['hedge_wins'] += int(won)
+
+
+def usage():
+    """CPU time of the process (including child processes)."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    return {'wall': time.monotonic(), 'cpu': cpu_time}
+
+
+def rss_mb():
+    """Current resident memory of the process, in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1024 ** 2
+    except OSError:
+        # (!) no /proc (e.g. macOS): fall back to the peak of the process,
+        # in bytes on macOS and in kilobytes elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def sample_rss():
+    while True:
+        rss = rss_mb()
+        with rss_lock:
+            for step, peak in rss_peaks.items():
+                rss_peaks[step] = max(peak, rss)
+        time.sleep(RSS_INTERVAL)
+
+
+def track_rss(step):
+    """Start sampling the memory used while `step` runs (see step_metrics)."""
+    global rss_sampler
+    with rss_lock:
+        rss_peaks[step] = rss_mb()
+        if rss_sampler is None:
+            rss_sampler = threading.Thread(target=sample_rss, daemon=True)
+            rss_sampler.start()
+
+
+def step_metrics(step, started, rows=None):
+    """Summary of what `step` used since `started` (a `usage()` snapshot),
+    and its peak RSS if tracked with track_rss().
+
+    (!) steps may run concurrently, and CPU time and RSS are measured for
+    the whole process, so they include concurrent steps."""
+    ended = usage()
+    duration = ended['wall'] - started['wall']
+    with calls_lock:
+        step_calls = calls.pop(step, {})
+    with rss_lock:
+        peak_rss = max(rss_peaks.pop(step, 0), rss_mb())
+    summary = {
+        'cpu_time': round(ended['cpu'] - started['cpu'], 3),
+        'peak_rss_mb': round(peak_rss, 1),
+        'rows': rows,
+        'rows_per_sec': round(rows / duration, 3) if rows and duration > 0 else None,
+        'calls': {},
+    }
+    for name, stats in step_calls.items():
+        latencies = stats.pop('latencies')
+        if len(latencies) > 0:
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            stats['latency'] = {'p50': round(p50, 4), 'p95': round(p95, 4),
+                                'p99': round(p99, 4), 'max': round(max(latencies), 4)}
+        summary['calls'][name] = stats
+    return summary
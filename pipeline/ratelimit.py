@@ -0,0 +1,305 @@
+"""Process-wide rate limiting of the API calls, per model.
+
+Every call waits for a concurrency slot and for its share of the model's
+requests/min and tokens/min budgets. The concurrency limit adapts like TCP
+congestion control (AIMD). It grows by about one slot per round of
+successful calls and halves when the provider answers 429 or 5xx, once per
+congestion event: failures of calls sent before the last decrease are
+ignored. Such failed calls are retried after a jittered exponential backoff."""
+
+import asyncio
+import functools
+import random
+import threading
+import time
+import openai
+import hedging
+from metrics import record_retry
+
+# per-model settings, overridden by the `rate_limits` field of the config
+DEFAULT_LIMITS = {
+    'rpm': None,  # requests per minute (None for no budget)
+    'tpm': None,  # tokens per minute (None for no budget)
+    'concurrency': 8,  # initial number of calls in flight
+    'max_concurrency': 64,
+}
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1  # seconds
+BACKOFF_CAP = 60  # seconds
+
+settings = {}
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def configure(rate_limits):
+    """Set the limits of each model ({model: {rpm, tpm, ...}})."""
+    with limiters_lock:
+        settings.clear()
+        settings.update(rate_limits)
+        limiters.clear()
+
+
+def limiter(model):
+    with limiters_lock:
+        if model not in limiters:
+            limiters[model] = AdaptiveLimiter(
+                **{**DEFAULT_LIMITS, **settings.get(model, {})})
+        return limiters[model]
+
+
+class TokenBucket:
+    """Budget of `per_minute` units, refilled continuously. Consuming more
+    than available is allowed and delays the next takers."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount):
+        """Consume `amount` units if available, else return the seconds to
+        wait for them."""
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self.refill()
+            if self.level >= amount:
+                self.level -= amount
+                return 0
+            return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        """Wait until `amount` units are available, then consume them."""
+        while (wait := self.try_take(amount)) > 0:
+            time.sleep(wait)
+
+    async def atake(self, amount):
+        while (wait := self.try_take(amount)) > 0:
+            await asyncio.sleep(wait)
+
+    def consume(self, amount):
+        with self.lock:
+            self.refill()
+            self.level -= amount
+
+
+class AdaptiveLimiter:
+
+    def __init__(self, rpm, tpm, concurrency, max_concurrency):
+        self.limit = concurrency
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        # number of decreases so far, to tell calls sent before the last one
+        self.epoch = 0
+        # end of the latest backoff of a call to this model
+        self.backoff_until = 0
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.condition = threading.Condition()
+        # (loop, future) of the coroutines waiting for a slot: they must not
+        # block a thread, since the calls they wait for may need one
+        self.waiters = []
+
+    def take_slot(self):
+        """Take a free slot, returning the epoch (None if none is free)."""
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+            return self.epoch
+
+    def acquire(self, tokens):
+        """Wait for a slot and the budgets of a call, returning the epoch to
+        pass to release()."""
+        with self.condition:
+            while (epoch := self.take_slot()) is None:
+                self.condition.wait()
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+        return epoch
+
+    async def aacquire(self, tokens):
+        """Same as acquire(), waiting in the event loop."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                epoch = self.take_slot()
+                if epoch is not None:
+                    break
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            await waiter
+        try:
+            if self.requests is not None:
+                await self.requests.atake(1)
+            if self.tokens is not None:
+                await self.tokens.atake(tokens)
+        except asyncio.CancelledError:
+            self.release(epoch, adapt=False)
+            raise
+        return epoch
+
+    def try_acquire(self, tokens):
+        """Take a slot and the budgets of a call if they are available right
+        away, returning the epoch (None if they are not)."""
+        epoch = self.take_slot()
+        if epoch is None:
+            return None
+        if self.requests is not None and self.requests.try_take(1) > 0:
+            self.release(epoch, adapt=False)
+            return None
+        if self.tokens is not None and self.tokens.try_take(tokens) > 0:
+            if self.requests is not None:
+                self.requests.consume(-1)  # give the request back
+            self.release(epoch, adapt=False)
+            return None
+        return epoch
+
+    def release(self, epoch, throttled=False, extra_tokens=0, adapt=True):
+        """Free the slot of a finished call. `extra_tokens` are the tokens it
+        used beyond what was reserved (e.g. the completion). Calls that were
+        given up (adapt=False) leave the concurrency limit unchanged."""
+        if self.tokens is not None and extra_tokens > 0:
+            self.tokens.consume(extra_tokens)
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                # (!) calls sent before the last decrease saw the same congestion
+                if epoch == self.epoch:
+                    self.limit = max(1, self.limit / 2)
+                    self.epoch += 1
+            elif adapt:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+            for loop, waiter in self.waiters:
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(wake, waiter)
+            self.waiters.clear()
+
+    def back_off(self, delay):
+        """Note that a call waits `delay` seconds before its next attempt."""
+        with self.condition:
+            self.backoff_until = max(self.backoff_until, time.monotonic() + delay)
+        return delay
+
+    def backing_off(self):
+        """Whether some call to this model is waiting to be retried."""
+        return time.monotonic() < self.backoff_until
+
+
+def wake(waiter):
+    if not waiter.done():  # (!) its coroutine may have been cancelled
+        waiter.set_result(None)
+
+
+def retryable(error):
+    """Whether the call may succeed later: rate limits, overloaded or
+    failing servers and network errors."""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    status = getattr(error, 'status_code', None)
+    return status is not None and (status in (408, 409, 429) or status >= 500)
+
+
+def backoff(attempt, error):
+    """Seconds to wait before the next attempt ("full jitter"), at least
+    what the provider asked for in its Retry-After header."""
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    response = getattr(error, 'response', None)
+    try:
+        retry_after = float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        retry_after = 0
+    return max(delay, min(retry_after, BACKOFF_CAP))
+
+
+def limited(limits, epoch, tokens, func, usage):
+    """func() in the slot taken at `epoch`, released when it finishes."""
+    try:
+        result = func()
+    except Exception as e:
+        limits.release(epoch, throttled=retryable(e))
+        raise
+    used = usage(result) if usage is not None else tokens
+    limits.release(epoch, extra_tokens=used - tokens)
+    return result
+
+
+async def alimited(limits, epoch, tokens, func, usage):
+    try:
+        result = await func()
+    except asyncio.CancelledError:
+        # the other request of a hedged call answered first
+        limits.release(epoch, adapt=False)
+        raise
+    except Exception as e:
+        limits.release(epoch, throttled=retryable(e))
+        raise
+    used = usage(result) if usage is not None else tokens
+    limits.release(epoch, extra_tokens=used - tokens)
+    return result
+
+
+def hedge(limits, tokens, wrapper, func, usage):
+    """Function reserving the slot and budgets of a duplicate request, which
+    returns the request to send (None when there are none available or some
+    call is backing off)."""
+    def reserve():
+        if limits.backing_off():
+            return None
+        epoch = limits.try_acquire(tokens)
+        if epoch is None:
+            return None
+        return functools.partial(wrapper, limits, epoch, tokens, func, usage)
+    return reserve
+
+
+def call(kind, model, tokens, func, *args, usage=None, hedge_fraction=0.0):
+    """Call func(*args) within the limits of `model`, reserving `tokens` and
+    retrying retryable errors. `usage(result)` may return the tokens actually
+    used, to charge the difference to the budget. Once dispatched, requests
+    are hedged (see hedging.call); the duplicate request takes its own slot
+    and budgets, and is not sent if they are not available right away."""
+    limits = limiter(model)
+    request = functools.partial(func, *args)
+    for attempt in range(MAX_ATTEMPTS):
+        epoch = limits.acquire(tokens)
+        try:
+            send = functools.partial(limited, limits, epoch, tokens, request, usage)
+            return hedging.call(
+                model, hedge_fraction, send,
+                reserve=hedge(limits, tokens, limited, request, usage))
+        except Exception as e:
+            if not retryable(e) or attempt == MAX_ATTEMPTS - 1:
+                raise
+            print(f"{type(e).__name__} from {model}, retrying ({attempt + 1})")
+            record_retry(kind, model)
+            time.sleep(limits.back_off(backoff(attempt, e)))
+
+
+async def acall(kind, model, tokens, func, *args, usage=None, hedge_fraction=0.0):
+    """Same as call() for a coroutine function."""
+    limits = limiter(model)
+    request = functools.partial(func, *args)
+    for attempt in range(MAX_ATTEMPTS):
+        epoch = await limits.aacquire(tokens)
+        try:
+            send = functools.partial(alimited, limits, epoch, tokens, request, usage)
+            return await hedging.acall(
+                model, hedge_fraction, send,
+                reserve=hedge(limits, tokens, alimited, request, usage))
+        except Exception as e:
+            if not retryable(e) or attempt == MAX_ATTEMPTS - 1:
+                raise
+            print(f"{type(e).__name__} from {model}, retrying ({attempt + 1})")
+            record_retry(kind, model)
+            await asyncio.sleep(limits.back_off(backoff(attempt, e)))
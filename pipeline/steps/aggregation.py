@@ -2,83 +2,233 @@
 
 from tqdm import tqdm
 from typing import List
+import numpy as np
 import pandas as pd
+import gzip
 import json
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# config fields only needed to build the report, left out of the bundle
+BUILD_ONLY_FIELDS = ['source_code', 'prompt', 'prompt_file', 'plan', 'status',
+                     'previous', 'current_jobs', 'completed_jobs', 'previously_completed_jobs',
+                     'lock_until', 'llm_cache', 'force', 'skip-interaction']
 
 
 def aggregation(config):
 
     path = f"outputs/{config['output_dir']}/result.json"
 
-    results = {
-        "clusters": [],
-        "comments": {},
-        "translations": {},
-        "overview": "",
-        "config": config,
-    }
-
     arguments = pd.read_csv(f"outputs/{config['output_dir']}/args.csv")
-    arguments.set_index('arg-id', inplace=True)
 
     comments = pd.read_csv(f"inputs/{config['input']}.csv")
     useful_comment_ids = set(arguments['comment-id'].values)
-    for _, row in comments.iterrows():
-        id = row['comment-id']
-        if id in useful_comment_ids:
-            res = {'comment': row['comment-body']}
-            numeric_cols = ['agrees', 'disagrees']
-            string_cols = ['video', 'interview', 'timestamp']
-            for col in numeric_cols:
-                if col in row:
-                    res[col] = float(row[col])
-            for col in string_cols:
-                if col in row:
-                    res[col] = row[col]
-            results['comments'][str(id)] = res
+    comments = comments[comments['comment-id'].isin(useful_comment_ids)]
+    comment_records = pd.DataFrame({'comment': comments['comment-body']})
+    numeric_cols = ['agrees', 'disagrees']
+    string_cols = ['video', 'interview', 'timestamp']
+    for col in numeric_cols:
+        if col in comments:
+            comment_records[col] = comments[col].astype(float)
+    for col in string_cols:
+        if col in comments:
+            comment_records[col] = comments[col]
+    results_comments = dict(zip(
+        comments['comment-id'].astype(str),
+        comment_records.to_dict('records')))
 
+    translations = {}
     languages = list(config.get('translation', {}).get('languages', []))
     if len(languages) > 0:
         with open(f"outputs/{config['output_dir']}/translations.json") as f:
-            translations = f.read()
-        results['translations'] = json.loads(translations)
+            translations = json.load(f)
 
     clusters = pd.read_csv(f"outputs/{config['output_dir']}/clusters.csv")
     labels = pd.read_csv(f"outputs/{config['output_dir']}/labels.csv")
     takeaways = pd.read_csv(f"outputs/{config['output_dir']}/takeaways.csv")
-    takeaways.set_index('cluster-id', inplace=True)
+    takeaways = takeaways.set_index('cluster-id')['takeaways']
 
     with open(f"outputs/{config['output_dir']}/overview.txt") as f:
         overview = f.read()
-    results['overview'] = overview
-
-    for _, row in labels.iterrows():
-        cid = row['cluster-id']
-        label = row['label']
-        arg_rows = clusters[clusters['cluster-id'] == cid]
-        arguments_in_cluster = []
-        for _, arg_row in arg_rows.iterrows():
-            arg_id = arg_row['arg-id']
-            argument = arguments.loc[arg_id]['argument']
-            comment_id = arguments.loc[arg_id]['comment-id']
-            x = float(arg_row['x'])
-            y = float(arg_row['y'])
-            p = float(arg_row['probability'])
-            obj = {
-                'arg_id': arg_id,
-                'argument': argument,
-                'comment_id': str(comment_id),
-                'x': x,
-                'y': y,
-                'p': p,
+
+    # one join instead of looking up each argument of each cluster
+    clusters = clusters.merge(
+        arguments[['arg-id', 'argument', 'comment-id']], on='arg-id', how='left')
+    cluster_arguments = pd.DataFrame({
+        'arg_id': clusters['arg-id'],
+        'argument': clusters['argument'],
+        'comment_id': clusters['comment-id'].astype(str),
+        'x': clusters['x'].astype(float),
+        'y': clusters['y'].astype(float),
+        'p': clusters['probability'].astype(float),
+    })
+    rows = clusters.groupby('cluster-id').indices
+
+    def results_clusters():
+        for cid, label in zip(labels['cluster-id'], labels['label']):
+            yield {
+                'cluster': label,
+                'cluster_id': str(cid),
+                'takeaways': takeaways.loc[cid],
+                'arguments': cluster_arguments.iloc[rows.get(cid, [])].to_dict('records')
             }
-            arguments_in_cluster.append(obj)
-        results['clusters'].append({
+
+    indent = None if config['aggregation']['compact'] else 2
+    with open(path, 'w') as file:
+        write_json(file, [
+            ('clusters', results_clusters()),
+            ('comments', results_comments),
+            ('translations', translations),
+            ('overview', overview),
+            ('config', config),
+        ], indent=indent)
+
+    if config['aggregation']['bundle']:
+        write_bundle(
+            f"outputs/{config['output_dir']}/bundle", labels, takeaways,
+            clusters['cluster-id'].values, cluster_arguments, results_comments,
+            translations, languages, overview, config,
+            config['aggregation']['chunk_size'])
+
+
+def write_json(file, items, indent=None):
+    """Write a JSON object from (key, value) items, streaming generator values
+    as arrays item by item. The output is the same as json.dump(dict(items))
+    with the same indent (or compact separators when indent is None)."""
+    separators = (',', ': ') if indent else (',', ':')
+
+    def newline(level):
+        return "\n" + " " * (indent * level) if indent else ""
+
+    def dumps(value, level):
+        text = json.dumps(value, indent=indent, separators=separators)
+        return text.replace("\n", newline(level)) if indent else text
+
+    file.write("{")
+    for i, (key, value) in enumerate(items):
+        file.write(("," if i > 0 else "") + newline(1) +
+                   json.dumps(key) + separators[1])
+        if isinstance(value, (list, dict, str, int, float, bool)) or value is None:
+            file.write(dumps(value, 1))
+            continue
+        file.write("[")
+        empty = True
+        for item in value:
+            file.write(("" if empty else ",") + newline(2) + dumps(item, 2))
+            empty = False
+        file.write("]" if empty else newline(1) + "]")
+    file.write(newline(0) + "}" if len(items) > 0 else "}")
+
+
+def write_bundle(folder, labels, takeaways, cluster_ids, arguments, comments,
+                 translations, languages, overview, config, chunk_size):
+    """Write the report as a folder of small files the frontend can load on
+    demand: a manifest (clusters, overview, config), packed little-endian
+    arrays for the points, and chunked JSON files for the texts. Every file
+    also gets a .gz (and .br when brotli is installed) variant."""
+    tmp = f"{folder}.tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    # points grouped by cluster so that each cluster is a contiguous range
+    cluster_index = {cid: i for i, cid in enumerate(labels['cluster-id'])}
+    index = pd.Series(cluster_ids).map(cluster_index).values
+    order = np.argsort(index, kind='stable')
+    arguments = arguments.iloc[order].reset_index(drop=True)
+    sizes = np.bincount(index, minlength=len(cluster_index))
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    comment_ids = list(comments.keys())
+    comment_index = {id: i for i, id in enumerate(comment_ids)}
+    arrays = {
+        'x': arguments['x'].values.astype('<f4'),
+        'y': arguments['y'].values.astype('<f4'),
+        'p': arguments['p'].values.astype('<f4'),
+        'cluster': index[order].astype('<u2'),
+        'comment': arguments['comment_id'].map(comment_index).fillna(-1).values.astype('<i4'),
+    }
+    for name, values in arrays.items():
+        write_file(tmp, f"{name}.bin", values.tobytes())
+
+    def chunks(n):
+        return [(k, slice(start, start + chunk_size))
+                for k, start in enumerate(range(0, n, chunk_size))]
+
+    argument_files = []
+    for k, rows in chunks(len(arguments)):
+        argument_files.append(f"arguments-{k}.json")
+        write_file(tmp, argument_files[-1], {
+            'arg_id': arguments['arg_id'].values[rows].tolist(),
+            'argument': arguments['argument'].values[rows].tolist(),
+            'comment_id': arguments['comment_id'].values[rows].tolist(),
+        })
+    comment_files = []
+    for k, rows in chunks(len(comment_ids)):
+        comment_files.append(f"comments-{k}.json")
+        write_file(tmp, comment_files[-1],
+                   {id: comments[id] for id in comment_ids[rows]})
+    # translations of the arguments are chunked like arguments-k.json (as
+    # lists in the same order), those of the other texts are kept together
+    argument_texts = set(arguments['argument'].values)
+    translation_files = {}
+    for i, language in enumerate(languages):
+        translation_files[language] = {
+            'texts': f"translations-{i}.json", 'arguments': []}
+        write_file(tmp, translation_files[language]['texts'], {
+            text: values[i] for text, values in translations.items()
+            if text not in argument_texts})
+        for k, rows in chunks(len(arguments)):
+            translation_files[language]['arguments'].append(f"translations-{i}-{k}.json")
+            write_file(tmp, translation_files[language]['arguments'][-1], [
+                translations[text][i] if text in translations else None
+                for text in arguments['argument'].values[rows]])
+
+    write_file(tmp, "manifest.json", {
+        'clusters': [{
             'cluster': label,
             'cluster_id': str(cid),
-            'takeaways': takeaways.loc[cid]['takeaways'],
-            'arguments': arguments_in_cluster
-        })
+            'takeaways': takeaways.loc[cid],
+            'start': int(start),
+            'size': int(size),
+        } for cid, label, start, size in zip(
+            labels['cluster-id'], labels['label'], starts, sizes)],
+        'overview': overview,
+        'config': report_config(config),
+        'count': len(arguments),
+        'chunk_size': chunk_size,
+        'arrays': {name: {'file': f"{name}.bin", 'dtype': values.dtype.str}
+                   for name, values in arrays.items()},
+        'arguments': argument_files,
+        'comments': comment_files,
+        'translations': translation_files,
+    })
 
-    with open(path, 'w') as file:
-        json.dump(results, file, indent=2)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp, folder)
+
+
+def write_file(folder, name, content):
+    """Write JSON or bytes content along with its precompressed variants."""
+    if not isinstance(content, bytes):
+        content = json.dumps(content, separators=(',', ':')).encode()
+    with open(f"{folder}/{name}", 'wb') as f:
+        f.write(content)
+    with open(f"{folder}/{name}.gz", 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(f"{folder}/{name}.br", 'wb') as f:
+            f.write(brotli.compress(content))
+
+
+def report_config(config):
+    """The config without the fields that only matter to the pipeline."""
+    return {key: ({k: v for k, v in value.items() if k not in BUILD_ONLY_FIELDS}
+                  if isinstance(value, dict) else value)
+            for key, value in config.items() if key not in BUILD_ONLY_FIELDS}
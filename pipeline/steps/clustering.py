@@ -1,20 +1,48 @@
 """Cluster the arguments using UMAP + HDBSCAN and GPT-4."""
 
+import hashlib
+import os
+import pickle
 import pandas as pd
 import numpy as np
 from importlib import import_module
+from steps.embedding import load_embeddings
+from utils import update_progress, argument_keys
+
+
+# options that define a fitted clustering (append mode requires them unchanged)
+FIT_OPTIONS = ['clusters', 'method', 'pca_components', 'min_cluster_size']
 
 
 def clustering(config):
     dataset = config['output_dir']
     path = f"outputs/{dataset}/clusters.csv"
+    state_path = f"outputs/{dataset}/clustering-state.pkl"
     arguments_df = pd.read_csv(f"outputs/{dataset}/args.csv")
     arguments_array = arguments_df["argument"].values
 
-    embeddings_df = pd.read_pickle(f"outputs/{dataset}/embeddings.pkl")
-    embeddings_array = np.asarray(embeddings_df["embedding"].values.tolist())
-    clusters = config['clustering']['clusters']
+    arg_ids, embeddings_array = load_embeddings(dataset)
+    if not np.array_equal(arg_ids, arguments_df["arg-id"].values.astype(str)):
+        raise Exception("Embeddings do not match args.csv, re-run embedding")
+    options = config['clustering']
+    keys = argument_keys(arguments_df)
+    update_progress(config, total=len(arguments_df))
 
+    if options['append'] and os.path.exists(path) and os.path.exists(state_path):
+        with open(state_path, 'rb') as f:
+            state = pickle.load(f)
+        previous = pd.read_csv(path, float_precision='round_trip')
+        result = append_clusters(
+            previous, state, arguments_df["arg-id"].values, keys, embeddings_array, options)
+        if result is not None:
+            result.to_csv(path, index=False)
+            state['placed'] = dict(zip(arguments_df["arg-id"].values, keys))
+            with open(state_path, 'wb') as f:
+                pickle.dump(state, f)
+            update_progress(config, incr=len(result))
+            return
+
+    models = {}
     result = cluster_embeddings(
         docs=arguments_array,
         embeddings=embeddings_array,
@@ -22,10 +50,78 @@ def clustering(config):
             "arg-id": arguments_df["arg-id"].values,
             "comment-id": arguments_df["comment-id"].values,
         },
-        n_topics=clusters,
+        min_cluster_size=options['min_cluster_size'],
+        n_topics=options['clusters'],
+        method=options['method'],
+        n_jobs=options['n_jobs'],
+        pca_components=options['pca_components'],
+        cache_dir=f"outputs/{dataset}/clustering-cache",
+        models=models,
+        keep_model=options['append'],
     )
     result.to_csv(path, index=False)
 
+    # keep what is needed to place later arguments on this same map
+    centroids = result.groupby('cluster-id')[['x', 'y']].mean()
+    with open(state_path, 'wb') as f:
+        pickle.dump({
+            'options': {key: options[key] for key in FIT_OPTIONS},
+            # arguments of the fit, and the argument placed in each row of
+            # clusters.csv (see argument_keys)
+            'fitted': set(keys),
+            'placed': dict(zip(arguments_df["arg-id"].values, keys)),
+            'umap-path': models['umap'],
+            'pca': models.get('pca'),
+            'cluster-ids': centroids.index.values,
+            'centroids': centroids.values,
+        }, f)
+    update_progress(config, incr=len(result))
+
+
+def append_clusters(previous, state, arg_ids, keys, embeddings, options):
+    """Place new arguments in the previously fitted clusters, or return
+    None when a full refit is needed.
+
+    (!) arg-ids are positional, so an argument is matched by its key (id
+    and text): a comment re-extracted into other arguments gets new places."""
+    if 'fitted' not in state or \
+            state['options'] != {key: options[key] for key in FIT_OPTIONS}:
+        print("Clustering options changed since last fit, refitting.")
+        return None
+    if state.get('umap-path') is None or not os.path.exists(state['umap-path']):
+        print("Fitted UMAP model not found, refitting.")
+        return None
+    new_since_fit = len([key for key in keys if key not in state['fitted']])
+    drift = new_since_fit / max(len(state['fitted']), 1)
+    if drift > options['drift_threshold']:
+        print(f"{drift:.0%} of the arguments are new since last fit, refitting.")
+        return None
+
+    placed = np.array([state['placed'].get(id) == key for id, key in zip(arg_ids, keys)],
+                      dtype=bool)
+    kept = previous[previous['arg-id'].isin(arg_ids[placed])]
+    is_new = ~placed
+    print(f"Appending {is_new.sum()} arguments to the existing clusters")
+    added = pd.DataFrame({'arg-id': arg_ids[is_new]})
+    if is_new.any():
+        new_embeddings = np.asarray(embeddings[np.flatnonzero(is_new)])
+        if state['pca'] is not None:
+            new_embeddings = state['pca'].transform(new_embeddings)
+        with open(state['umap-path'], 'rb') as f:
+            umap_model = pickle.load(f)
+        umap_embeds = umap_model.transform(new_embeddings)
+        distances = ((umap_embeds[:, None, :] -
+                     state['centroids'][None]) ** 2).sum(axis=2)
+        added['x'] = umap_embeds[:, 0].astype(float)
+        added['y'] = umap_embeds[:, 1].astype(float)
+        added['probability'] = 1.0
+        added['cluster-id'] = state['cluster-ids'][distances.argmin(axis=1)]
+    result = pd.concat([kept, added], ignore_index=True)
+    # (!) without new arguments, concat turns the ids into floats
+    result['cluster-id'] = result['cluster-id'].astype(int)
+    # same row order as args.csv
+    return result.set_index('arg-id').loc[arg_ids].reset_index()
+
 
 def cluster_embeddings(
     docs,
@@ -34,43 +130,226 @@ def cluster_embeddings(
     min_cluster_size=2,
     n_components=2,
     n_topics=6,
+    method="spectral",
+    n_jobs=None,
+    pca_components=50,
+    cache_dir=None,
+    models=None,
+    keep_model=False,
 ):
+    """Project the embeddings to 2D with UMAP and partition them with one of:
+
+    - spectral: spectral clustering of the UMAP projection (default)
+    - kmeans: mini-batch k-means on a PCA reduction, for 100k+ arguments
+    - hdbscan: HDBSCAN on the UMAP projection (`n_topics` is ignored)
+
+    With a `cache_dir`, the projection and the kNN affinity graph are saved
+    there under a fingerprint of the embeddings, so that a new partition of
+    the same embeddings (e.g. another cluster count) skips refitting them.
+    With `keep_model` (for append mode), the fitted UMAP model is also saved
+    there. Its path (None if not saved) and the PCA model are stored in
+    `models` when given.
+    """
+    if method not in CLUSTERING_METHODS:
+        raise Exception(f"Unknown clustering method '{method}'")
+
     # (!) we import the following modules dynamically for a reason
     # (they are slow to load and not required for all pipelines)
-    SpectralClustering = import_module('sklearn.cluster').SpectralClustering
     UMAP = import_module('umap').UMAP
 
-    umap_model = UMAP(
-        random_state=42,
-        n_components=n_components,
+    artifacts = ArtifactCache(cache_dir, embeddings_fingerprint(embeddings))
+    key = f"umap{n_components}"
+    if method == "kmeans":
+        # UMAP on the reduced matrix is much cheaper than on raw embeddings
+        key = f"pca{pca_components}-{key}"
+        pca_model = artifacts.get(
+            f"pca{pca_components}.pkl",
+            lambda: fit_pca(embeddings, pca_components))
+        embeddings = pca_model.transform(embeddings)
+        if models is not None:
+            models['pca'] = pca_model
+
+    # UMAP降次元
+    def fit_umap():
+        umap_model = UMAP(
+            random_state=42,
+            n_components=n_components,
+        ).fit(embeddings)
+        # (!) the model holds a copy of the embeddings, so it is only kept
+        # for append mode and re-clusterings just load the projection
+        if keep_model:
+            artifacts.put(f"{key}.pkl", umap_model)
+        return umap_model.embedding_
+
+    # a projection cached without its model is refitted when the model is needed
+    refit = keep_model and not artifacts.exists(f"{key}.pkl")
+    umap_embeds = artifacts.get(f"{key}.npy", fit_umap, refresh=refit)
+    if models is not None:
+        models['umap'] = artifacts.path(f"{key}.pkl") if keep_model else None
+
+    cluster_labels, probabilities = CLUSTERING_METHODS[method](
+        embeddings=embeddings,
+        umap_embeds=umap_embeds,
+        n_topics=n_topics,
+        min_cluster_size=min_cluster_size,
+        n_jobs=n_jobs,
+        artifacts=artifacts,
+        key=key,
     )
+    artifacts.clean()
+
+    # 結果データフレーム作成
+    result = pd.DataFrame({
+        'arg-id': metadatas['arg-id'],
+        'x': umap_embeds[:, 0].astype(float),
+        'y': umap_embeds[:, 1].astype(float),
+        'probability': probabilities,
+        'cluster-id': cluster_labels.astype(int),
+    })
+    return result
+
+
+def fit_pca(embeddings, n_components):
+    PCA = import_module('sklearn.decomposition').PCA
+    n_components = min(n_components, *embeddings.shape)
+    pca = PCA(n_components=n_components, svd_solver='randomized', random_state=42)
+    return pca.fit(np.asarray(embeddings, dtype=np.float32))
+
+
+def spectral_clusters(umap_embeds, n_topics, n_jobs, artifacts, key, **kwargs):
+    SpectralClustering = import_module('sklearn.cluster').SpectralClustering
+    kneighbors_graph = import_module('sklearn.neighbors').kneighbors_graph
 
     # 日本語対応：埋め込みベクトルのみでクラスタリング
-    n_samples = len(embeddings)
+    n_samples = len(umap_embeds)
     n_neighbors = min(n_samples - 1, 10)
+
+    # same affinity as SpectralClustering(affinity="nearest_neighbors"),
+    # computed once per projection
+    def affinity_graph():
+        connectivity = kneighbors_graph(
+            umap_embeds, n_neighbors=n_neighbors, include_self=True, n_jobs=n_jobs)
+        return 0.5 * (connectivity + connectivity.T)
+
+    affinity = artifacts.get(f"{key}-knn{n_neighbors}.npz", affinity_graph)
     spectral_model = SpectralClustering(
         n_clusters=n_topics,
-        affinity="nearest_neighbors",
-        n_neighbors=n_neighbors,
-        random_state=42
+        affinity="precomputed",
+        random_state=42,
+        n_jobs=n_jobs,
     )
-    
-    # UMAP降次元
-    umap_embeds = umap_model.fit_transform(embeddings)
-    
+
     # スペクトラルクラスタリング実行
-    cluster_labels = spectral_model.fit_predict(umap_embeds)
+    cluster_labels = spectral_model.fit_predict(affinity)
+    # 確信度は1.0で固定
+    return cluster_labels, np.ones(n_samples)
 
-    # 結果データフレーム作成
-    result_data = []
-    for i, (doc, cluster_id) in enumerate(zip(docs, cluster_labels)):
-        result_data.append({
-            'arg-id': metadatas['arg-id'][i],
-            'x': float(umap_embeds[i, 0]),
-            'y': float(umap_embeds[i, 1]),
-            'probability': 1.0,  # 確信度は1.0で固定
-            'cluster-id': int(cluster_id)
-        })
-    
-    result = pd.DataFrame(result_data)
-    return result
+
+def kmeans_clusters(embeddings, n_topics, n_jobs, **kwargs):
+    MiniBatchKMeans = import_module('sklearn.cluster').MiniBatchKMeans
+    threadpool_limits = import_module('threadpoolctl').threadpool_limits
+
+    kmeans_model = MiniBatchKMeans(
+        n_clusters=n_topics,
+        batch_size=4096,
+        n_init=3,
+        random_state=42,
+    )
+    # k-means is parallelised with OpenMP threads rather than n_jobs
+    limits = n_jobs if n_jobs is not None and n_jobs > 0 else None
+    with threadpool_limits(limits=limits):
+        cluster_labels = kmeans_model.fit_predict(embeddings)
+    return cluster_labels, np.ones(len(embeddings))
+
+
+def hdbscan_clusters(umap_embeds, min_cluster_size, n_jobs, **kwargs):
+    HDBSCAN = import_module('hdbscan').HDBSCAN
+
+    hdbscan_model = HDBSCAN(
+        min_cluster_size=min_cluster_size,
+        core_dist_n_jobs=n_jobs if n_jobs is not None else 4,
+    )
+    cluster_labels = hdbscan_model.fit_predict(umap_embeds)
+    probabilities = hdbscan_model.probabilities_
+
+    # every argument must belong to a cluster in the report, so noise
+    # points join the cluster with the nearest centroid
+    noise = cluster_labels < 0
+    found = np.unique(cluster_labels[~noise])
+    if len(found) == 0:
+        return np.zeros(len(umap_embeds), dtype=int), np.ones(len(umap_embeds))
+    if noise.any():
+        centroids = np.array([umap_embeds[cluster_labels == c].mean(axis=0)
+                              for c in found])
+        distances = ((umap_embeds[noise, None, :] - centroids[None]) ** 2).sum(axis=2)
+        cluster_labels[noise] = found[distances.argmin(axis=1)]
+    return cluster_labels, probabilities
+
+
+def embeddings_fingerprint(embeddings):
+    digest = hashlib.sha256(f"{embeddings.shape}{embeddings.dtype}".encode())
+    for i in range(0, len(embeddings), 10000):
+        digest.update(np.ascontiguousarray(embeddings[i: i + 10000]).tobytes())
+    return digest.hexdigest()[:16]
+
+
+class ArtifactCache:
+    """Intermediate clustering results (.npz sparse matrices, .npy arrays or
+    .pkl fitted models) saved under the fingerprint of the embeddings."""
+
+    def __init__(self, cache_dir, fingerprint):
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+
+    def path(self, name):
+        if self.cache_dir is None:
+            return None
+        return f"{self.cache_dir}/{self.fingerprint}-{name}"
+
+    def exists(self, name):
+        return self.path(name) is not None and os.path.exists(self.path(name))
+
+    def get(self, name, compute, refresh=False):
+        path = self.path(name)
+        if path is None:
+            return compute()
+        if os.path.exists(path) and not refresh:
+            print(f"Reusing {path}")
+            if path.endswith('.npz'):
+                return import_module('scipy.sparse').load_npz(path)
+            if path.endswith('.npy'):
+                return np.load(path)
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        value = compute()
+        self.put(name, value)
+        return value
+
+    def put(self, name, value):
+        path = self.path(name)
+        if path is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if path.endswith('.npz'):
+            sparse = import_module('scipy.sparse')
+            sparse.save_npz(path, sparse.csr_matrix(value))
+        elif path.endswith('.npy'):
+            np.save(path, value)
+        else:
+            with open(path, 'wb') as f:
+                pickle.dump(value, f)
+
+    def clean(self):
+        """Delete artifacts computed from other embeddings."""
+        if self.cache_dir is None or not os.path.exists(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith(self.fingerprint):
+                os.remove(f"{self.cache_dir}/{name}")
+
+
+CLUSTERING_METHODS = {
+    'spectral': spectral_clusters,
+    'kmeans': kmeans_clusters,
+    'hdbscan': hdbscan_clusters,
+}
@@ -1,26 +1,179 @@
 
-from langchain_openai import OpenAIEmbeddings
+import hashlib
+import os
+import time
+import numpy as np
 import pandas as pd
+from importlib import import_module
+from langchain_openai import OpenAIEmbeddings
 from tqdm import tqdm
+import ratelimit
+from cache import SqliteCache
+from metrics import record_call
+from utils import run_concurrently, token_counts, token_batches, update_progress
+
+# embeddings are shared by all jobs and re-runs, only new texts are sent out
+embedding_cache = SqliteCache(
+    "outputs/embedding_cache.sqlite", max_bytes=10 * 1024 ** 3)
+
+
+# rows read from the cache (or written to it) at once
+CHUNK_SIZE = 10000
 
 
 def embedding(config):
     dataset = config['output_dir']
-    path = f"outputs/{dataset}/embeddings.pkl"
     arguments = pd.read_csv(f"outputs/{dataset}/args.csv")
-    embeddings = []
-    
-    # 最新の埋め込みモデルを使用
-    embedding_model = OpenAIEmbeddings(model="text-embedding-3-large")
-    
-    for i in tqdm(range(0, len(arguments), 1000)):
-        args = arguments["argument"].tolist()[i: i + 1000]
-        embeds = embedding_model.embed_documents(args)
-        embeddings.extend(embeds)
-    df = pd.DataFrame(
-        [
-            {"arg-id": arguments.iloc[i]["arg-id"], "embedding": e}
-            for i, e in enumerate(embeddings)
-        ]
-    )
-    df.to_pickle(path)
+    texts = arguments["argument"].tolist()
+    options = config['embedding']
+
+    if options['backend'] not in BACKENDS:
+        raise Exception(f"Unknown embedding backend '{options['backend']}'")
+    embed = BACKENDS[options['backend']]
+    update_progress(config, total=len(texts))
+
+    # (!) vectors are written to embeddings.npy as they are read or computed,
+    # so that the whole matrix is never held in memory
+    writer = EmbeddingsWriter(dataset, len(texts), options['dtype'])
+    keys = [embedding_key(options['model'], text) for text in texts]
+    missing = {}  # {key: rows of args.csv}
+    found = 0
+    for start in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[start: start + CHUNK_SIZE]
+        cached = embedding_cache.get_many(set(chunk))
+        rows = [start + i for i, key in enumerate(chunk) if key in cached]
+        if len(rows) > 0:
+            writer.write(rows, np.stack([np.frombuffer(cached[keys[row]], dtype=np.float32)
+                                         for row in rows]))
+        for i, key in enumerate(chunk):
+            if key not in cached:
+                missing.setdefault(key, []).append(start + i)
+        found += len(rows)
+        update_progress(config, incr=len(rows))
+    print(f"Embedding {len(missing)} new arguments, "
+          f"{found} found in cache")
+
+    missing_keys = list(missing.keys())
+    missing_texts = [texts[missing[key][0]] for key in missing_keys]
+    for positions, embeds in embed(missing_texts, options) if len(missing) > 0 else []:
+        embeds = np.asarray(embeds, dtype=np.float32)
+        rows = []
+        for position, vector in zip(positions, embeds):
+            embedding_cache.put(missing_keys[position], vector.tobytes())
+            rows += missing[missing_keys[position]]
+        writer.write(rows, np.repeat(embeds, [len(missing[missing_keys[p]])
+                                              for p in positions], axis=0))
+        update_progress(config, incr=len(rows))
+    writer.close(arguments["arg-id"].values)
+
+
+def embed_openai(texts, options):
+    """Yield (positions in texts, embeddings) for each batch, as they come."""
+    embedding_model = OpenAIEmbeddings(
+        model=options['model'], chunk_size=options['max_batch_size'], max_retries=0)
+    batches = token_batches(
+        texts, options['model'], options['max_batch_tokens'], options['max_batch_size'])
+    starts = np.concatenate([[0], np.cumsum([len(batch) for batch in batches])])
+    calls = [(embedding_model, batch, options['model']) for batch in batches]
+    for i, embeds in tqdm(run_concurrently(
+            embed_batch, calls, options['concurrency']),
+            total=len(calls)):
+        yield range(starts[i], starts[i + 1]), embeds
+
+
+def embed_batch(embedding_model, texts, model):
+    tokens = sum(token_counts(texts, model))
+
+    def request():
+        started = time.monotonic()
+        embeds = embedding_model.embed_documents(texts)
+        record_call('embedding', model, time.monotonic() - started, prompt_tokens=tokens)
+        return embeds
+
+    return ratelimit.call('embedding', model, tokens, request)
+
+
+def embed_local(texts, options):
+    """Embed texts on CPU with sentence-transformers, using all cores, and
+    yield (positions in texts, embeddings) for every CHUNK_SIZE texts."""
+    SentenceTransformer = import_module(
+        'sentence_transformers').SentenceTransformer
+    embedding_model = SentenceTransformer(options['model'], device='cpu')
+    batch_size = options['batch_size']
+    processes = options['processes'] or os.cpu_count()
+
+    # sort by length so that each batch is padded to similar lengths
+    order = np.argsort([len(text) for text in texts], kind='stable')
+    pool = None
+    if processes > 1 and len(texts) > batch_size:
+        pool = embedding_model.start_multi_process_pool(
+            target_devices=['cpu'] * processes)
+    try:
+        for start in range(0, len(texts), CHUNK_SIZE):
+            positions = order[start: start + CHUNK_SIZE]
+            chunk = [texts[i] for i in positions]
+            if pool is not None:
+                embeds = embedding_model.encode_multi_process(
+                    chunk, pool, batch_size=batch_size,
+                    chunk_size=max(batch_size, len(chunk) // (processes * 4)))
+            else:
+                embeds = embedding_model.encode(
+                    chunk, batch_size=batch_size, show_progress_bar=True)
+            yield positions, embeds
+    finally:
+        if pool is not None:
+            embedding_model.stop_multi_process_pool(pool)
+
+
+BACKENDS = {
+    'openai': embed_openai,
+    'local': embed_local,
+}
+
+
+def embedding_key(model, text):
+    return model + ":" + hashlib.sha256(text.encode()).hexdigest()
+
+
+class EmbeddingsWriter:
+    """Rows of outputs/<dataset>/embeddings.npy, written in any order as they
+    come. The file (with the matching arg-ids in embeddings-ids.npy) only
+    replaces the previous one on close()."""
+
+    def __init__(self, dataset, count, dtype='float32'):
+        self.dataset = dataset
+        self.count = count
+        self.dtype = dtype
+        self.tmp_path = f"outputs/{dataset}/embeddings.tmp.npy"
+        self.matrix = None
+
+    def write(self, rows, vectors):
+        if self.matrix is None:
+            # the dimension is only known from the first vectors
+            self.matrix = np.lib.format.open_memmap(
+                self.tmp_path, mode='w+', dtype=self.dtype,
+                shape=(self.count, vectors.shape[1]))
+        self.matrix[rows] = vectors
+
+    def close(self, arg_ids):
+        if self.matrix is None:
+            self.matrix = np.lib.format.open_memmap(
+                self.tmp_path, mode='w+', dtype=self.dtype, shape=(0, 0))
+        self.matrix.flush()
+        self.matrix = None
+        np.save(f"outputs/{self.dataset}/embeddings-ids.npy",
+                np.asarray(arg_ids, dtype=str))
+        os.replace(self.tmp_path, f"outputs/{self.dataset}/embeddings.npy")
+
+
+def load_embeddings(dataset):
+    """Return (arg_ids, matrix) with the matrix memory-mapped read-only.
+
+    Outputs of older runs (embeddings.pkl) are converted in memory."""
+    path = f"outputs/{dataset}/embeddings.npy"
+    if not os.path.exists(path) and os.path.exists(f"outputs/{dataset}/embeddings.pkl"):
+        df = pd.read_pickle(f"outputs/{dataset}/embeddings.pkl")
+        matrix = np.asarray(df["embedding"].values.tolist(), dtype=np.float32)
+        return df["arg-id"].values.astype(str), matrix
+    arg_ids = np.load(f"outputs/{dataset}/embeddings-ids.npy")
+    return arg_ids, np.load(path, mmap_mode='r')
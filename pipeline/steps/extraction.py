@@ -1,10 +1,32 @@
 import os
+import re
 import json
+import hashlib
+import openai
 from tqdm import tqdm
 import pandas as pd
-from langchain_openai import ChatOpenAI
-from utils import messages, update_progress
-import concurrent.futures
+from functools import partial
+import llm
+from metrics import record_retry, record_repair, record_give_up
+from utils import messages, update_progress, run_concurrently, \
+    step_journal, should_resume, token_batches, strip_code_fences
+
+PACKED_INSTRUCTIONS = "Extract the arguments of each comment of the following JSON " + \
+    "object, as above. Return only a JSON object with the same keys and, as " + \
+    "values, the JSON list of arguments of each comment:"
+# single comments are answered as {"arguments": [...]} in JSON mode
+ARGUMENTS_FORMAT = {'type': 'json_schema', 'json_schema': {
+    'name': 'arguments',
+    'strict': True,
+    'schema': {
+        'type': 'object',
+        'properties': {'arguments': {'type': 'array', 'items': {'type': 'string'}}},
+        'required': ['arguments'],
+        'additionalProperties': False,
+    },
+}}
+# (model, response format type) that were rejected during this run
+json_mode_unsupported = set()
 
 
 def extraction(config):
@@ -16,51 +38,185 @@ def extraction(config):
     prompt = config['extraction']['prompt']
     workers = config['extraction']['workers']
     limit = config['extraction']['limit']
+    gateway = llm.gateway(config['extraction'])
 
     comment_ids = (comments['comment-id'].values)[:limit]
-    comments.set_index('comment-id', inplace=True)
-    results = pd.DataFrame()
+    inputs = (comments['comment-body'].values)[:limit]
+
+    journal = step_journal(config, 'extraction')
+    params = {'model': model,
+              'prompt': hashlib.sha256(prompt.encode()).hexdigest()}
+    done = read_journal(journal, params) if should_resume(config, 'extraction') else {}
+    if len(done) > 0:
+        print(f"Resuming extraction: {len(done)} comments already extracted")
+
     update_progress(config, total=len(comment_ids))
-    for i in tqdm(range(0, len(comment_ids), workers)):
-        batch = comment_ids[i: i + workers]
-        batch_inputs = [comments.loc[id]['comment-body'] for id in batch]
-        batch_results = extract_batch(batch_inputs, prompt, model, workers)
-        for comment_id, extracted_args in zip(batch, batch_results):
-            for j, arg in enumerate(extracted_args):
-                new_row = {"arg-id": f"A{comment_id}_{j}",
-                           "comment-id": int(comment_id), "argument": arg}
-                results = pd.concat(
-                    [results, pd.DataFrame([new_row])], ignore_index=True)
-        update_progress(config, incr=len(batch))
+    update_progress(config, incr=len([id for id in comment_ids if int(id) in done]))
+    pending = [i for i, id in enumerate(comment_ids) if int(id) not in done]
+    # several comments per request (with pack_size > 1) saves re-sending the prompt
+    groups, start = [], 0
+    for batch in token_batches([inputs[i] for i in pending], model,
+                               config['extraction']['pack_tokens'],
+                               config['extraction']['pack_size']):
+        groups.append(pending[start:start + len(batch)])
+        start += len(batch)
+    # keep `workers` calls in flight so one slow response never stalls the others
+    calls = [([inputs[i] for i in group],) for group in groups]
+    extract = partial(extract_packed, prompt=prompt, gateway=gateway,
+                      json_mode=config['extraction']['json_mode'])
+    with open_journal(journal, params, append=len(done) > 0) as f:
+        for k, group_args in tqdm(
+                run_concurrently(extract, calls, workers), total=len(calls)):
+            for i, extracted_args in zip(groups[k], group_args):
+                comment_id = int(comment_ids[i])
+                done[comment_id] = extracted_args
+                f.write(json.dumps(
+                    {'comment-id': comment_id, 'arguments': extracted_args}) + "\n")
+            f.flush()
+            update_progress(config, incr=len(groups[k]))
+
+    rows = []
+    for comment_id in comment_ids:
+        for j, arg in enumerate(done[int(comment_id)]):
+            rows.append({"arg-id": f"A{comment_id}_{j}",
+                         "comment-id": int(comment_id), "argument": arg})
+    results = pd.DataFrame(rows, columns=["arg-id", "comment-id", "argument"])
     results.to_csv(path, index=False)
+    os.remove(journal)
+
+
+def open_journal(journal, params, append):
+    """Open the extraction journal, starting a new one unless appending."""
+    if append:
+        f = open(journal, 'a+')
+        # terminate a line truncated when the previous run was killed
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        return f
+    f = open(journal, 'w')
+    f.write(json.dumps({'params': params}) + "\n")
+    return f
+
+
+def read_journal(journal, params):
+    """Return {comment-id: arguments} recorded by an interrupted run."""
+    done = {}
+    with open(journal) as f:
+        lines = f.read().splitlines()
+    if len(lines) == 0 or json.loads(lines[0]).get('params') != params:
+        print("Extraction journal was written with other parameters, starting over.")
+        return done
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except json.decoder.JSONDecodeError:
+            # last line may be truncated if the previous run was killed mid-write
+            continue
+        done[entry['comment-id']] = entry['arguments']
+    return done
+
 
+def extract_packed(inputs, prompt, gateway, json_mode=True):
+    """Extract the arguments of several comments in one request, returning
+    one list of arguments per comment.
 
-def extract_batch(batch, prompt, model, workers):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = [executor.submit(
-            extract_arguments, input, prompt, model) for input in list(batch)]
-        concurrent.futures.wait(futures)
-        return [future.result() for future in futures]
+    The answer is requested in JSON mode (when `json_mode` and the model
+    supports it). Malformed answers that cannot be repaired locally (invalid
+    JSON, missing or extra ids) are retried by splitting the comments in
+    two, down to single comments."""
+    if len(inputs) == 1:
+        return [extract_arguments(inputs[0], prompt, gateway, json_mode=json_mode)]
+    payload = {str(i): text for i, text in enumerate(inputs)}
+    prompt_messages = messages(
+        prompt, f"{PACKED_INSTRUCTIONS}\n\n{json.dumps(payload, ensure_ascii=False)}")
+    response, response_format = invoke_json(
+        gateway, prompt_messages, {'type': 'json_object'}, json_mode)
+    try:
+        obj = parse_json(response, gateway.model, opening='{')
+        if not isinstance(obj, dict) or set(obj.keys()) != set(payload.keys()):
+            raise ValueError(f"expected ids 0 to {len(inputs) - 1}")
+        return [argument_list(obj[id]) for id in payload]
+    except ValueError as e:
+        # (json.decoder.JSONDecodeError is a ValueError)
+        print(f"Invalid extraction for {len(inputs)} comments ({e}), splitting them")
+        gateway.forget(prompt_messages, response_format)
+        record_retry('llm', gateway.model)
+        half = len(inputs) // 2
+        return extract_packed(inputs[:half], prompt, gateway, json_mode=json_mode) + \
+            extract_packed(inputs[half:], prompt, gateway, json_mode=json_mode)
+
+
+def invoke_json(gateway, prompt_messages, response_format, json_mode):
+    """The model's answer, requested with `response_format` when `json_mode`
+    and the model has not rejected that format before, and the format used
+    (None if the answer was requested without it)."""
+    unsupported = (gateway.model, response_format['type'])
+    if json_mode and unsupported not in json_mode_unsupported:
+        try:
+            return gateway.invoke(prompt_messages, response_format=response_format), \
+                response_format
+        except openai.BadRequestError as e:
+            print(f"Warning: '{gateway.model}' rejected {response_format['type']} "
+                  f"responses, not using them ({e})")
+            json_mode_unsupported.add(unsupported)
+    return gateway.invoke(prompt_messages), None
+
+
+def argument_list(obj):
+    # answers in JSON mode wrap the list as {"arguments": [...]}
+    if isinstance(obj, dict) and set(obj.keys()) == {'arguments'}:
+        obj = obj['arguments']
+    # LLM sometimes returns valid JSON string
+    if isinstance(obj, str):
+        obj = [obj]
+    if not isinstance(obj, list) or not all(isinstance(a, str) for a in obj):
+        raise ValueError("expected a list of strings")
+    items = [a.strip() for a in obj]
+    items = list(filter(None, items))  # omit empty strings
+    return items
+
+
+def parse_json(response, model, opening='['):
+    """Parse a JSON answer, first repairing common defects locally: code
+    fences, trailing commas, and text around the first JSON array (or
+    object, with opening='{')."""
+    try:
+        return json.loads(response)
+    except ValueError:
+        pass
+    text = re.sub(r',\s*([\]}])', r'\1', strip_code_fences(response))
+    try:
+        obj = json.loads(text)
+    except ValueError:
+        start = text.find(opening)
+        if start < 0:
+            raise ValueError("no JSON found in answer")
+        obj, _ = json.JSONDecoder().raw_decode(text[start:])
+    record_repair('llm', model)
+    return obj
 
 
-def extract_arguments(input, prompt, model, retries=3):
-    llm = ChatOpenAI(model=model, temperature=0.0)
-    response = llm.invoke(messages(prompt, input)).content.strip()
+def extract_arguments(input, prompt, gateway, retries=3, json_mode=True):
+    prompt_messages = messages(prompt, input)
+    response, response_format = invoke_json(
+        gateway, prompt_messages, ARGUMENTS_FORMAT, json_mode)
+    response = response.strip()
     try:
-        obj = json.loads(response)
-        # LLM sometimes returns valid JSON string
-        if isinstance(obj, str):
-            obj = [obj]
-        items = [a.strip() for a in obj]
-        items = filter(None, items)  # omit empty strings
-        return items
-    except json.decoder.JSONDecodeError as e:
+        return argument_list(parse_json(response, gateway.model))
+    except ValueError as e:
         print("JSON error:", e)
         print("Input was:", input)
         print("Response was:", response)
+        # don't let the cache serve the same invalid answer again
+        gateway.forget(prompt_messages, response_format)
         if retries > 0:
             print("Retrying...")
-            return extract_arguments(input, prompt, model, retries - 1)
+            record_retry('llm', gateway.model)
+            return extract_arguments(input, prompt, gateway, retries - 1, json_mode)
         else:
-            print("Silently giving up on trying to generate valid list.")
+            print("Giving up on trying to generate valid list, comment skipped.")
+            record_give_up('llm', gateway.model)
             return []
@@ -4,8 +4,10 @@ from tqdm import tqdm
 from typing import List
 import numpy as np
 import pandas as pd
-from langchain_openai import ChatOpenAI
-from utils import messages, update_progress
+import llm
+from utils import messages, update_progress, unchanged_clusters, \
+    save_memberships, run_concurrently, cluster_members, cluster_keys, \
+    sample_positions, sample_outside, member_rng
 
 
 def labelling(config):
@@ -15,53 +17,62 @@ def labelling(config):
     arguments = pd.read_csv(f"outputs/{dataset}/args.csv")
     clusters = pd.read_csv(f"outputs/{dataset}/clusters.csv")
 
-    results = pd.DataFrame()
-
     sample_size = config['labelling']['sample_size']
     prompt = config['labelling']['prompt']
-    model = config['labelling']['model']
+    gateway = llm.gateway(config['labelling'])
+    workers = config['labelling']['workers']
 
     question = config['question']
     cluster_ids = clusters['cluster-id'].unique()
+    texts, members = cluster_members(clusters, arguments)
+
+    # clusters that barely changed since the last run keep their label
+    memberships = cluster_keys(arguments, members)
+    reusable = unchanged_clusters(config, 'labelling', memberships)
+    previous = {}
+    if len(reusable) > 0:
+        previous = pd.read_csv(path).set_index('cluster-id')['label'].to_dict()
+
+    labels = [previous.get(cluster_id) if cluster_id in reusable else None
+              for cluster_id in cluster_ids]
+    todo = [i for i, label in enumerate(labels) if label is None]
+    reused = {cid for cid, label in zip(cluster_ids, labels) if label is not None}
+
+    # every clustered position and its cluster, to sample other clusters from
+    positions = np.concatenate([[]] + list(members.values())).astype(int)
+    owners = np.repeat(list(members.keys()), [len(p) for p in members.values()])
+
+    calls = []
+    for i in todo:
+        args_sample = texts[sample_positions(members[cluster_ids[i]], sample_size)]
+        args_sample_outside = texts[sample_outside(
+            positions, owners, cluster_ids[i], sample_size,
+            member_rng(members[cluster_ids[i]]))]
+        calls.append((question, args_sample, args_sample_outside, prompt, gateway))
 
     update_progress(config, total=len(cluster_ids))
+    update_progress(config, incr=len(cluster_ids) - len(todo))
 
-    for _, cluster_id in tqdm(enumerate(cluster_ids), total=len(cluster_ids)):
-        args_ids = clusters[clusters['cluster-id']
-                            == cluster_id]['arg-id'].values
-        args_ids = np.random.choice(args_ids, size=min(
-            len(args_ids), sample_size), replace=False)
-        args_sample = arguments[arguments['arg-id']
-                                .isin(args_ids)]['argument'].values
-
-        args_ids_outside = clusters[clusters['cluster-id']
-                                    != cluster_id]['arg-id'].values
-        args_ids_outside = np.random.choice(args_ids_outside, size=min(
-            len(args_ids_outside), sample_size), replace=False)
-        args_sample_outside = arguments[arguments['arg-id']
-                                        .isin(args_ids_outside)]['argument'].values
-
-        label = generate_label(question, args_sample,
-                               args_sample_outside, prompt, model)
-        results = pd.concat([results, pd.DataFrame(
-            [{'cluster-id': cluster_id, 'label': label}])], ignore_index=True)
+    for k, label in tqdm(run_concurrently(generate_label, calls, workers), total=len(calls)):
+        labels[todo[k]] = label
         update_progress(config, incr=1)
 
+    results = pd.DataFrame({'cluster-id': cluster_ids, 'label': labels})
     results.to_csv(path, index=False)
+    save_memberships(config, 'labelling', memberships, reused)
 
 
-def generate_label(question, args_sample, args_sample_outside, prompt, model):
-    llm = ChatOpenAI(model=model, temperature=0.0)
+def generate_label(question, args_sample, args_sample_outside, prompt, gateway):
     outside = '\n * ' + '\n * '.join(args_sample_outside)
     inside = '\n * ' + '\n * '.join(args_sample)
     input = f"Question of the consultation:{question}\n\n" + \
         f"Examples of arguments OUTSIDE the cluster:\n {outside}" + \
         f"Examples of arguments INSIDE the cluster:\n {inside}"
-    response = llm.invoke(messages(prompt, input))
-    return response.content.strip()
+    response = gateway.invoke(messages(prompt, input))
+    return response.strip()
 
 
-def label_cluster(cluster: pd.DataFrame, question: str, opposite_args: List[str], prompt: str, model: str):
+def label_cluster(cluster: pd.DataFrame, question: str, opposite_args: List[str], prompt: str, gateway: llm.Gateway):
     sample_size = len(cluster)
     sample_cluster = cluster.sample(n=min(sample_size, 30), random_state=42)
     sampled_args = [f" * {arg}" for arg in sample_cluster["argument"].values]
@@ -81,7 +92,6 @@ Examples of arguments inside the cluster:
 
 {sampled_args_text}"""
 
-    llm = ChatOpenAI(model=model, temperature=0.0)
-    response = llm.invoke(messages(prompt, input_text))
-    label = response.content.strip()
+    response = gateway.invoke(messages(prompt, input_text))
+    label = response.strip()
     return label
@@ -4,7 +4,7 @@ from tqdm import tqdm
 from typing import List
 import numpy as np
 import pandas as pd
-from langchain_openai import ChatOpenAI
+import llm
 from utils import messages, update_progress
 
 
@@ -16,7 +16,7 @@ def overview(config):
     takeaways = pd.read_csv(f"outputs/{dataset}/takeaways.csv")
 
     prompt = config['overview']['prompt']
-    model = config['overview']['model']
+    gateway = llm.gateway(config['overview'])
 
     question = config['question']
 
@@ -26,7 +26,8 @@ def overview(config):
     all_labels = labels['label'].values
     all_takeaways = takeaways['takeaways'].values
 
-    overview_text = generate_overview(question, all_labels, all_takeaways, prompt, model)
+    overview_text = generate_overview(
+        question, all_labels, all_takeaways, prompt, gateway)
 
     with open(path, 'w') as f:
         f.write(overview_text)
@@ -34,9 +35,7 @@ def overview(config):
     update_progress(config, incr=1)
 
 
-def generate_overview(question, labels, takeaways, prompt, model):
-    llm = ChatOpenAI(model=model, temperature=0.0)
-    
+def generate_overview(question, labels, takeaways, prompt, gateway):
     labels_text = '\n * ' + '\n * '.join(labels)
     takeaways_text = '\n * ' + '\n * '.join(takeaways)
     
@@ -44,5 +43,5 @@ def generate_overview(question, labels, takeaways, prompt, model):
             f"Cluster labels:\n{labels_text}\n\n" + \
             f"Cluster takeaways:\n{takeaways_text}"
     
-    response = llm.invoke(messages(prompt, input))
-    return response.content.strip()
+    response = gateway.invoke(messages(prompt, input))
+    return response.strip()
@@ -4,8 +4,9 @@ from tqdm import tqdm
 from typing import List
 import numpy as np
 import pandas as pd
-from langchain_openai import ChatOpenAI
-from utils import messages, update_progress
+import llm
+from utils import messages, update_progress, unchanged_clusters, \
+    save_memberships, run_concurrently, cluster_members, cluster_keys, sample_positions
 
 
 def takeaways(config):
@@ -15,37 +16,45 @@ def takeaways(config):
     arguments = pd.read_csv(f"outputs/{dataset}/args.csv")
     clusters = pd.read_csv(f"outputs/{dataset}/clusters.csv")
 
-    results = pd.DataFrame()
-
     sample_size = config['takeaways']['sample_size']
     prompt = config['takeaways']['prompt']
-    model = config['takeaways']['model']
+    gateway = llm.gateway(config['takeaways'])
+    workers = config['takeaways']['workers']
 
     question = config['question']
-    cluster_ids = clusters['cluster-id'].unique()
+    cluster_ids = np.sort(clusters['cluster-id'].unique())
+    texts, members = cluster_members(clusters, arguments)
+
+    # clusters that barely changed since the last run keep their takeaways
+    memberships = cluster_keys(arguments, members)
+    reusable = unchanged_clusters(config, 'takeaways', memberships)
+    previous = {}
+    if len(reusable) > 0:
+        previous = pd.read_csv(path).set_index('cluster-id')['takeaways'].to_dict()
+
+    results = [previous.get(cluster_id) if cluster_id in reusable else None
+               for cluster_id in cluster_ids]
+    todo = [i for i, takeaway in enumerate(results) if takeaway is None]
+    reused = {cid for cid, takeaway in zip(cluster_ids, results) if takeaway is not None}
+    calls = [(question, texts[sample_positions(members[cluster_ids[i]], sample_size)],
+              prompt, gateway) for i in todo]
 
     update_progress(config, total=len(cluster_ids))
+    update_progress(config, incr=len(cluster_ids) - len(todo))
 
-    for _, cluster_id in tqdm(enumerate(cluster_ids), total=len(cluster_ids)):
-        args_ids = clusters[clusters['cluster-id']
-                            == cluster_id]['arg-id'].values
-        args_ids = np.random.choice(args_ids, size=min(
-            len(args_ids), sample_size), replace=False)
-        args_sample = arguments[arguments['arg-id']
-                                .isin(args_ids)]['argument'].values
-
-        takeaway = generate_takeaways(question, args_sample, prompt, model)
-        results = pd.concat([results, pd.DataFrame(
-            [{'cluster-id': cluster_id, 'takeaways': takeaway}])], ignore_index=True)
+    for k, takeaway in tqdm(run_concurrently(generate_takeaways, calls, workers), total=len(calls)):
+        results[todo[k]] = takeaway
         update_progress(config, incr=1)
 
+    # rows in cluster-id order whichever call finished first
+    results = pd.DataFrame({'cluster-id': cluster_ids, 'takeaways': results})
     results.to_csv(path, index=False)
+    save_memberships(config, 'takeaways', memberships, reused)
 
 
-def generate_takeaways(question, args_sample, prompt, model):
-    llm = ChatOpenAI(model=model, temperature=0.0)
+def generate_takeaways(question, args_sample, prompt, gateway):
     inside = '\n * ' + '\n * '.join(args_sample)
     input = f"Question of the consultation:{question}\n\n" + \
         f"Examples of arguments:\n {inside}"
-    response = llm.invoke(messages(prompt, input))
-    return response.content.strip()
+    response = gateway.invoke(messages(prompt, input))
+    return response.strip()
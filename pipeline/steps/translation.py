@@ -1,9 +1,18 @@
 """Translate text to multiple languages."""
 
+import hashlib
 import json
-from langchain_openai import ChatOpenAI
-from utils import messages, update_progress
-from langchain_core.messages import AIMessage
+import pandas as pd
+from tqdm import tqdm
+import llm
+from cache import SqliteCache
+from metrics import record_retry
+from utils import typed_message, update_progress, run_concurrently, \
+    token_batches, strip_code_fences
+
+# translation memory shared by all jobs, keyed by (text, language, model)
+translation_memory = SqliteCache(
+    "outputs/translation_memory.sqlite", max_bytes=1024 ** 3)
 
 
 def translation(config):
@@ -16,99 +25,93 @@ def translation(config):
             json.dump({}, file, indent=2)
         return
 
-    result = {}
-
-    # Translate config items
-    result = translate_config(config, result, languages)
-
-    # Translate arguments
-    result = translate_arguments(config, result, languages)
-
-    # Translate clusters
-    result = translate_clusters(config, result, languages)
-
-    # Translate overview
-    result = translate_overview(config, result, languages)
-
+    model = config['translation']['model']
+    cache = config['translation']['cache']
+    gateway = llm.gateway(config['translation'])
+    workers = config['translation']['workers']
+
+    texts = collect_texts(config)
+
+    # strings translated by any previous run (of any job) are reused as is
+    translated = {}
+    calls = []
+    for language in languages:
+        keys = [memory_key(text, language, model) for text in texts]
+        found = translation_memory.get_many(keys) if cache else {}
+        translated[language] = {text: found[key]
+                                for text, key in zip(texts, keys) if key in found}
+        missing = [text for text in texts if text not in translated[language]]
+        print(f"Translating {len(missing)} new strings to {language}, "
+              f"{len(translated[language])} found in translation memory")
+        batches = token_batches(missing, model, config['translation']['max_batch_tokens'],
+                                config['translation']['batch_size'])
+        calls += [(batch, language, gateway) for batch in batches]
+
+    update_progress(config, total=sum(len(batch) for batch, _, _ in calls))
+    for i, translations in tqdm(run_concurrently(translate_batch, calls, workers), total=len(calls)):
+        language = calls[i][1]
+        translated[language].update(translations)
+        for text, translation in translations.items():
+            translation_memory.put(memory_key(text, language, model), translation)
+        update_progress(config, incr=len(translations))
+
+    result = {text: [translated[language][text] for language in languages]
+              for text in texts}
     with open(path, 'w') as file:
         json.dump(result, file, indent=2)
 
 
-def translate_config(config, result, languages):
-    for field in ['name', 'question', 'intro']:
-        if field in config and config[field]:
-            result[config[field]] = []
-            for language in languages:
-                translation = translate_text(config[field], language, config['translation']['model'])
-                result[config[field]].append(translation)
-    return result
-
-
-def translate_arguments(config, result, languages):
-    import pandas as pd
-    arguments = pd.read_csv(f"outputs/{config['output_dir']}/args.csv")
-    
-    update_progress(config, total=len(arguments))
-    
-    for _, row in arguments.iterrows():
-        argument_text = row['argument']
-        if argument_text not in result:
-            result[argument_text] = []
-            for language in languages:
-                translation = translate_text(argument_text, language, config['translation']['model'])
-                result[argument_text].append(translation)
-        update_progress(config, incr=1)
-    
-    return result
-
-
-def translate_clusters(config, result, languages):
-    import pandas as pd
-    labels = pd.read_csv(f"outputs/{config['output_dir']}/labels.csv")
-    takeaways = pd.read_csv(f"outputs/{config['output_dir']}/takeaways.csv")
-    
-    # Translate labels
-    for _, row in labels.iterrows():
-        label_text = row['label']
-        if label_text not in result:
-            result[label_text] = []
-            for language in languages:
-                translation = translate_text(label_text, language, config['translation']['model'])
-                result[label_text].append(translation)
-    
-    # Translate takeaways
-    for _, row in takeaways.iterrows():
-        takeaway_text = row['takeaways']
-        if takeaway_text not in result:
-            result[takeaway_text] = []
-            for language in languages:
-                translation = translate_text(takeaway_text, language, config['translation']['model'])
-                result[takeaway_text].append(translation)
-    
-    return result
-
-
-def translate_overview(config, result, languages):
+def memory_key(text, language, model):
+    return f"{model}:{language}:" + hashlib.sha256(text.encode()).hexdigest()
+
+
+def collect_texts(config):
+    """All unique strings shown in the report, in a stable order."""
+    dataset = config['output_dir']
+    texts = [config[field] for field in ['name', 'question', 'intro']
+             if field in config and config[field]]
+    texts += list(pd.read_csv(f"outputs/{dataset}/args.csv")['argument'].values)
+    texts += list(pd.read_csv(f"outputs/{dataset}/labels.csv")['label'].values)
+    texts += list(pd.read_csv(f"outputs/{dataset}/takeaways.csv")['takeaways'].values)
     try:
-        with open(f"outputs/{config['output_dir']}/overview.txt", 'r') as f:
-            overview_text = f.read().strip()
-            if overview_text and overview_text not in result:
-                result[overview_text] = []
-                for language in languages:
-                    translation = translate_text(overview_text, language, config['translation']['model'])
-                    result[overview_text].append(translation)
+        with open(f"outputs/{dataset}/overview.txt", 'r') as f:
+            texts.append(f.read().strip())
     except FileNotFoundError:
         pass
-    
-    return result
-
-
-def translate_text(text, language, model):
-    llm = ChatOpenAI(model=model, temperature=0.0)
+    return list(dict.fromkeys(t for t in texts if isinstance(t, str) and t))
+
+
+def translate_batch(texts, language, gateway):
+    """Translate texts in one request, returning {text: translation}.
+
+    Malformed answers (invalid JSON, missing or extra ids) are retried by
+    splitting the batch in two, down to single texts."""
+    if len(texts) == 1:
+        return {texts[0]: translate_text(texts[0], language, gateway)}
+    payload = {str(i): text for i, text in enumerate(texts)}
+    prompt = f"Translate each value of the following JSON object to {language}. " + \
+        "Return only a JSON object with the same keys and the translations as values:"
+    prompt_messages = [typed_message(
+        'human', f"{prompt}\n\n{json.dumps(payload, ensure_ascii=False)}")]
+    response = gateway.invoke(prompt_messages)
+    try:
+        obj = json.loads(strip_code_fences(response))
+        if not isinstance(obj, dict) or set(obj.keys()) != set(payload.keys()):
+            raise ValueError(f"expected ids 0 to {len(texts) - 1}")
+        if not all(isinstance(v, str) for v in obj.values()):
+            raise ValueError("expected string translations")
+        return {text: obj[id].strip() for id, text in payload.items()}
+    except ValueError as e:
+        # (json.decoder.JSONDecodeError is a ValueError)
+        print(f"Invalid batch translation to {language} ({e}), splitting batch")
+        gateway.forget(prompt_messages)
+        record_retry('llm', gateway.model)
+        half = len(texts) // 2
+        return {**translate_batch(texts[:half], language, gateway),
+                **translate_batch(texts[half:], language, gateway)}
+
+
+def translate_text(text, language, gateway):
     prompt = f"Translate the following text to {language}. Return only the translation without any additional text or explanation:"
-    response = llm.invoke(messages("", f"{prompt}\n\n{text}"))
-    
-    if isinstance(response, AIMessage):
-        return response.content.strip()
-    else:
-        return response.content.strip()
+    response = gateway.invoke([typed_message('human', f"{prompt}\n\n{text}")])
+    return response.strip()
@@ -1,12 +1,37 @@
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from datetime import datetime, timedelta
+import concurrent.futures
+import contextvars
+import hashlib
 import json
 import os
+import threading
+import time
 import traceback
+import numpy as np
+import pandas as pd
+import ratelimit
+from llm import cache_stats, token_counts
+from metrics import current_step, usage, track_rss, step_metrics
 
 with open("./specs.json") as f:
     specs = json.load(f)
 
+# steps may run concurrently, so status updates are serialized with this lock
+status_lock = threading.RLock()
+# set when the run state changed since status.json was last written
+status_dirty = threading.Event()
+
+# the parts of config that change while the pipeline runs, stored in
+# status.json (the rest is stored once per run in config.json)
+RUN_STATE = ['previous', 'plan', 'status', 'start_time', 'end_time', 'lock_until',
+             'current_jobs', 'completed_jobs', 'previously_completed_jobs',
+             'llm_cache', 'error', 'error_stack_trace']
+# progress is written to status.json at most this often (seconds)...
+STATUS_INTERVAL = 1
+# ...and the run state at least this often, to keep the job lock fresh
+LOCK_REFRESH = 60
+
 
 def typed_message(t, m):
     if t == "system":
@@ -36,12 +61,63 @@ def messages(prompt, input):
     return [typed_message(t, m) for (t, m) in results]
 
 
+def run_concurrently(func, inputs, workers):
+    """Call func(*args) for each args tuple in inputs, keeping exactly
+    `workers` calls in flight, and yield (index, result) as calls finish."""
+    pending = {}
+    inputs = enumerate(inputs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit_next():
+            for i, args in inputs:
+                # (!) run in a copy of the caller's context (e.g. current_step)
+                pending[executor.submit(
+                    contextvars.copy_context().run, func, *args)] = i
+                return
+
+        for _ in range(workers):
+            submit_next()
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                submit_next()
+                yield i, future.result()
+
+
+def token_batches(texts, model, max_tokens, max_size):
+    """Split texts into consecutive batches of at most `max_size` texts and
+    `max_tokens` tokens (a longer text gets a batch of its own)."""
+    batches = []
+    batch, batch_tokens = [], 0
+    for text, count in zip(texts, token_counts(texts, model)):
+        if len(batch) > 0 and (batch_tokens + count > max_tokens or len(batch) >= max_size):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += count
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def strip_code_fences(response):
+    """The content of a markdown code block (e.g. ```json ... ```)."""
+    response = response.strip()
+    if response.startswith("```"):
+        response = response.split("\n", 1)[-1]
+        response = response.rsplit("```", 1)[0]
+    return response
+
+
 def validate_config(config):
     if not 'input' in config:
         raise Exception("Missing required field 'input' in config")
     if not 'question' in config:
         raise Exception("Missing required field 'question' in config")
-    valid_fields = ['input', 'question', 'model', 'name', 'intro']
+    valid_fields = ['input', 'question', 'model', 'name', 'intro', 'cache',
+                    'rate_limits']
     step_names = [x['step'] for x in specs]
     for key in config:
         if key not in valid_fields and key not in step_names:
@@ -49,7 +125,8 @@ def validate_config(config):
     for step_spec in specs:
         valid_options = list(step_spec.get('options', {}).keys())
         if step_spec.get('use_llm'):
-            valid_options = valid_options + ['prompt', 'model', 'prompt_file']
+            valid_options = valid_options + \
+                ['prompt', 'model', 'prompt_file', 'cache']
         for key in config.get(step_spec['step'], {}):
             if key not in valid_options:
                 raise Exception(
@@ -73,7 +150,7 @@ def decide_what_to_run(config, previous):
         keys = step['dependencies']['params']
         if step.get('use_llm', False):
             # automagically track prompt and model for llm jobs
-            keys += ['prompt', 'model']
+            keys = keys + ['prompt', 'model']
         match = [x for x in previous_jobs if x['step'] == step['step']]
         prev = match[0]['params']
         next = config[step['step']]
@@ -92,6 +169,8 @@ def decide_what_to_run(config, previous):
         reason = None
         found_prev = len(
             [x for x in previous_jobs if x['step'] == step['step']]) > 0
+        resume = False
+        incremental = False
         if config.get('force', False):
             reason = 'forced with -f'
         elif config.get('only', None) != None and config['only'] != stepname:
@@ -99,6 +178,9 @@ def decide_what_to_run(config, previous):
             reason = 'forced another step with -o'
         elif config.get('only') == stepname:
             reason = 'forced this step with -o'
+        elif 'journal' in step and os.path.exists(step_journal(config, stepname)):
+            resume = True
+            reason = 'resuming interrupted run'
         elif not found_prev:
             reason = 'not trace of previous run'
         elif not os.path.exists(f"outputs/{config['output_dir']}/{step['filename']}"):
@@ -110,6 +192,8 @@ def decide_what_to_run(config, previous):
             if len(changing_deps) > 0:
                 reason = 'some dependent steps will re-run: ' + \
                     (", ".join(changing_deps))
+                # with unchanged params, previous outputs may be partly reused
+                incremental = len(different_params(step)) == 0
             else:
                 diff_params = different_params(step)
                 if len(diff_params) > 0:
@@ -119,10 +203,117 @@ def decide_what_to_run(config, previous):
                 else:
                     run = False
                     reason = 'nothing changed'
-        plan.append({'step': stepname, 'run': run, 'reason': reason})
+        plan.append({'step': stepname, 'run': run, 'reason': reason,
+                     'resume': resume, 'incremental': incremental})
     return plan
 
 
+def step_journal(config, step):
+    """Path of the append-only journal of a resumable step."""
+    spec = [x for x in specs if x['step'] == step][0]
+    return f"outputs/{config['output_dir']}/{spec['journal']}"
+
+
+def should_resume(config, step):
+    plan = [x for x in config['plan'] if x['step'] == step][0]
+    return plan.get('resume', False)
+
+
+def argument_keys(arguments):
+    """Key of each argument of args.csv: its id and a hash of its text, as
+    re-extracting a comment can give other texts under the same ids."""
+    return np.array([f"{id}:{hashlib.sha256(str(text).encode()).hexdigest()[:16]}"
+                     for id, text in zip(arguments['arg-id'], arguments['argument'])])
+
+
+def cluster_keys(arguments, members):
+    """{cluster id: keys of its arguments} (see cluster_members)."""
+    keys = argument_keys(arguments)
+    return {cid: set(keys[positions]) for cid, positions in members.items()}
+
+
+def members_path(config, step):
+    return f"outputs/{config['output_dir']}/{step}-members.json"
+
+
+def unchanged_clusters(config, step, memberships):
+    """Ids of the clusters whose membership changed by at most the step's
+    `relabel_threshold` since the step generated their result (see
+    clustering's append mode and save_memberships)."""
+    plan = [x for x in config['plan'] if x['step'] == step][0]
+    path = members_path(config, step)
+    if not plan.get('incremental', False) or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        previous = json.load(f)
+    threshold = config[step]['relabel_threshold']
+    unchanged = set()
+    for cid, keys in memberships.items():
+        if str(cid) in previous:
+            old = set(previous[str(cid)])
+            if len(old ^ keys) / max(len(old), 1) <= threshold:
+                unchanged.add(cid)
+    return unchanged
+
+
+def save_memberships(config, step, memberships, reused):
+    """Record the membership each cluster's result was generated from: the
+    previous one for `reused` clusters, so that small changes add up."""
+    previous = {}
+    if len(reused) > 0:
+        with open(members_path(config, step)) as f:
+            previous = json.load(f)
+    snapshot = {str(cid): sorted(previous[str(cid)] if cid in reused else keys)
+                for cid, keys in memberships.items()}
+    with open(members_path(config, step), 'w') as f:
+        json.dump(snapshot, f)
+
+
+def cluster_members(clusters, arguments):
+    """Return the argument texts and, for each cluster id, the positions of
+    its arguments in that array (computed once instead of per cluster)."""
+    texts = arguments['argument'].values
+    positions = pd.Index(arguments['arg-id']).get_indexer(clusters['arg-id'])
+    members = {cid: positions[rows] for cid, rows in
+               clusters.groupby('cluster-id').indices.items()}
+    return texts, members
+
+
+def member_rng(positions):
+    """Random generator seeded by a set of argument positions, so that the
+    same cluster membership gives the same samples, and the same prompts
+    (which can then be answered from the LLM cache)."""
+    positions = np.sort(np.asarray(positions, dtype=np.int64))
+    digest = hashlib.sha256(positions.tobytes()).digest()
+    return np.random.default_rng(int.from_bytes(digest[:8], 'little'))
+
+
+def sample_positions(positions, sample_size, rng=None):
+    """Random sample of positions, kept in the original order of arguments
+    (seeded by the positions themselves unless an `rng` is given)."""
+    positions = np.asarray(positions, dtype=int)
+    rng = member_rng(positions) if rng is None else rng
+    sample = rng.choice(positions, size=min(
+        len(positions), sample_size), replace=False)
+    return np.sort(sample)
+
+
+def sample_outside(positions, owners, cluster_id, sample_size, rng):
+    """Random sample of the positions whose owner is not `cluster_id`, kept in
+    the original order of arguments. Rows are drawn at random and those of the
+    cluster rejected, so the cost depends on the sample size rather than on
+    the number of arguments."""
+    chosen = {}
+    for _ in range(10 if len(positions) > 0 else 0):
+        rows = rng.integers(len(positions), size=2 * sample_size)
+        for row in rows[owners[rows] != cluster_id]:
+            chosen[row] = None
+            if len(chosen) == sample_size:
+                return np.sort(positions[list(chosen)])
+    # (!) the cluster holds (almost) all the arguments, take the complement
+    return sample_positions(positions[owners != cluster_id], sample_size, rng)
+
+
 def initialization(sysargv):
 
     job_file = sysargv[1]
@@ -149,6 +340,8 @@ def initialization(sysargv):
     if os.path.exists(f"outputs/{output_dir}/status.json"):
         with open(f"outputs/{output_dir}/status.json") as f:
             previous = json.load(f)
+        # (status files written before config.json existed hold the full config)
+        previous = {k: v for k, v in previous.items() if k in RUN_STATE}
         config['previous'] = previous
 
     # crash if job is already running and locked
@@ -159,6 +352,9 @@ def initialization(sysargv):
         else:
             print("Hum, the last Job crashed a while ago...Proceeding!")
 
+    # requests/min and tokens/min budgets of each model
+    ratelimit.configure(config.get('rate_limits', {}))
+
     # set default LLM model
     if not 'model' in config:
         config['model'] = 'gpt-4.1-2025-04-14'
@@ -190,6 +386,9 @@ def initialization(sysargv):
             if not 'model' in config.get(step):
                 if 'model' in config:
                     config[step]['model'] = config['model']
+            # resolve whether cached LLM answers may be reused
+            if not 'cache' in config.get(step):
+                config[step]['cache'] = config.get('cache', True)
 
     # create output directory if needed
     if not os.path.exists(f"outputs/{output_dir}"):
@@ -205,6 +404,8 @@ def initialization(sysargv):
         input()
 
     # ready to start!
+    write_json(f"outputs/{output_dir}/config.json",
+               {k: v for k, v in config.items() if k not in RUN_STATE})
     update_status(config, {
         'plan': plan,
         'status': 'running',
@@ -216,27 +417,63 @@ def initialization(sysargv):
 
 # (!) make sure to always use this function to update status...
 def update_status(config, updates):
+    with status_lock:
+        for key, value in updates.items():
+            if value is None and key in config:
+                del config[key]
+            else:
+                config[key] = value
+        flush_status(config)
+
+
+def flush_status(config):
+    """Write the run state to status.json and extend the job lock."""
     output_dir = config['output_dir']
-    for key, value in updates.items():
-        if value is None and key in config:
-            del config[key]
+    with status_lock:
+        status_dirty.clear()
+        config['lock_until'] = (datetime.now() + timedelta(minutes=5)).isoformat()
+        write_json(f"outputs/{output_dir}/status.json",
+                   {key: config[key] for key in RUN_STATE if key in config})
+
+
+def write_json(path, data):
+    # write then rename, so that a crash never leaves a truncated file
+    with open(f"{path}.tmp", 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def status_writer(config, stop):
+    """Flush the progress of running steps to status.json in the background."""
+    last_flush = time.monotonic()
+    while not stop.wait(STATUS_INTERVAL):
+        if status_dirty.is_set() or time.monotonic() - last_flush > LOCK_REFRESH:
+            flush_status(config)
+            last_flush = time.monotonic()
+
+
+def update_job(config, step, updates):
+    """Update the entry of a running step in config['current_jobs'] (written
+    to status.json by the background status writer)."""
+    with status_lock:
+        # (!) replaced rather than mutated, config may be dumped meanwhile
+        jobs = dict(config.get('current_jobs', {}))
+        if updates is None:
+            del jobs[step]
         else:
-            config[key] = value
-    config['lock_until'] = (datetime.now() + timedelta(minutes=5)).isoformat()
-    with open(f"outputs/{output_dir}/status.json", 'w') as file:
-        json.dump(config, file, indent=2)
+            jobs[step] = {**jobs.get(step, {}), **updates}
+        config['current_jobs'] = jobs
+        status_dirty.set()
 
 
 def update_progress(config, incr=None, total=None):
-    if total is not None:
-        update_status(config, {
-            'current_job_progress': 0,
-            'current_jop_tasks': total
-        })
-    elif incr is not None:
-        update_status(config, {
-            'current_job_progress': config['current_job_progress'] + incr
-        })
+    step = current_step.get()
+    with status_lock:
+        if total is not None:
+            update_job(config, step, {'progress': 0, 'tasks': total})
+        elif incr is not None:
+            progress = config['current_jobs'][step]['progress'] + incr
+            update_job(config, step, {'progress': progress})
 
 
 def run_step(step, func, config):
@@ -246,26 +483,69 @@ def run_step(step, func, config):
         print(f"Skipping '{step}'")
         return
     # update status before running...
-    update_status(config, {
-        'current_job': step,
-        'current_job_started': datetime.now().isoformat(),
-    })
+    started = datetime.now()
+    started_usage = usage()
+    track_rss(step)
+    update_job(config, step, {'started': started.isoformat()})
     print('Running step:', step)
     # run the step...
-    func(config)
+    token = current_step.set(step)
+    try:
+        func(config)
+    finally:
+        current_step.reset(token)
     # update status after running...
-    update_status(config, {
-        'current_job_progress': None,
-        'current_jop_tasks': None,
-        'completed_jobs': config.get('completed_jobs', []) + [{
+    with status_lock:
+        rows = config['current_jobs'][step].get('tasks')
+        job = {
             'step': step,
             'completed': datetime.now().isoformat(),
-            'duration': (
-                datetime.fromisoformat(datetime.now().isoformat()) -
-                datetime.fromisoformat(config['current_job_started'])).total_seconds(),
-            'params': config[step]
-        }]
-    })
+            'duration': (datetime.now() - started).total_seconds(),
+            'metrics': step_metrics(step, started_usage, rows),
+        }
+        # one line per step and run, to compare runs of the same job
+        with open(f"outputs/{config['output_dir']}/metrics.jsonl", 'a') as f:
+            f.write(json.dumps({'run': config['start_time'], **job}) + '\n')
+        update_job(config, step, None)
+        update_status(config, {
+            'llm_cache': cache_stats(),
+            'completed_jobs': config.get('completed_jobs', []) + [{
+                **job,
+                'params': {k: v for k, v in config[step].items()
+                           if k != 'source_code'}
+            }]
+        })
+
+
+def run_pipeline(steps, config):
+    """Run each step of `steps` ({name: func}) as soon as the steps it depends
+    on in specs.json are done, running independent steps concurrently."""
+    dependencies = {x['step']: set(x['dependencies']['steps']) & set(steps)
+                    for x in specs if x['step'] in steps}
+    done = set()
+    running = {}
+    stop = threading.Event()
+    writer = threading.Thread(target=status_writer, args=(config, stop), daemon=True)
+    writer.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(steps)) as executor:
+            while len(done) < len(steps):
+                for step, func in steps.items():
+                    ready = dependencies[step] <= done
+                    if ready and step not in done and step not in running.values():
+                        future = executor.submit(
+                            contextvars.copy_context().run, run_step, step, func, config)
+                        running[future] = step
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    # (!) steps that are already running finish before we raise
+                    future.result()
+                    done.add(step)
+    finally:
+        stop.set()
+        writer.join()
 
 
 def termination(config, error=None):
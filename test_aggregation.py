@@ -0,0 +1,69 @@
+"""Tests of the streaming JSON writer of the aggregation step.
+
+Run from the top level directory with: python -m pytest test_aggregation.py
+"""
+
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline'))
+
+from steps.aggregation import write_json
+
+
+def streamed(items, indent):
+    file = io.StringIO()
+    write_json(file, items, indent=indent)
+    return file.getvalue()
+
+
+def expected(items, indent):
+    obj = {key: list(value) if hasattr(value, '__next__') else value
+           for key, value in items}
+    if indent:
+        return json.dumps(obj, indent=indent)
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def sample_items():
+    return [
+        ('config', {'name': 'Test', 'languages': ['French', 'Japanese'], 'nested': {'a': [1, {}]}}),
+        ('clusters', (({'cluster_id': str(i), 'arguments': [{'x': i / 3, 'p': 1.0}]}
+                       for i in range(3)))),
+        ('comments', {'1': {'comment': 'Accents é and "quotes"\n'}}),
+        ('translations', {}),
+        ('overview', 'Some text'),
+        ('count', 3),
+        ('ok', True),
+        ('missing', None),
+        ('empty_list', []),
+    ]
+
+
+def test_indented_output_matches_json_dumps():
+    assert streamed(sample_items(), 2) == expected(sample_items(), 2)
+
+
+def test_compact_output_matches_json_dumps():
+    assert streamed(sample_items(), None) == expected(sample_items(), None)
+
+
+def test_empty_generator_is_an_empty_array():
+    for indent in [2, None]:
+        items = [('clusters', (x for x in [])), ('count', 0)]
+        assert streamed(items, indent) == expected([('clusters', []), ('count', 0)], indent)
+
+
+def test_generator_of_nested_values():
+    def items():
+        return [('rows', ([i, {'values': list(range(i))}] for i in range(4)))]
+    for indent in [2, None]:
+        assert streamed(items(), indent) == expected(items(), indent)
+        assert json.loads(streamed(items(), indent)) == json.loads(expected(items(), indent))
+
+
+def test_no_items():
+    assert streamed([], 2) == json.dumps({}, indent=2)
+    assert streamed([], None) == json.dumps({})
@@ -0,0 +1,65 @@
+"""Tests of the local repair of JSON answers in the extraction step.
+
+Run from the top level directory with: python -m pytest test_extraction.py
+"""
+
+import os
+import sys
+
+import pytest
+
+PIPELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline')
+sys.path.insert(0, PIPELINE)
+# (!) utils reads ./specs.json when imported
+os.chdir(PIPELINE)
+
+import metrics
+from steps.extraction import parse_json, argument_list
+
+MODEL = 'test-model'
+
+
+def repairs():
+    return metrics.call_stats('llm', MODEL)['repairs']
+
+
+def test_valid_json_is_not_a_repair():
+    before = repairs()
+    assert parse_json('["a", "b"]', MODEL) == ['a', 'b']
+    assert repairs() == before
+
+
+def test_code_fences():
+    before = repairs()
+    assert parse_json('```json\n["a", "b"]\n```', MODEL) == ['a', 'b']
+    assert parse_json('```\n{"arguments": ["a"]}\n```', MODEL, opening='{') == {'arguments': ['a']}
+    assert repairs() == before + 2
+
+
+def test_trailing_commas():
+    assert parse_json('["a", "b",]', MODEL) == ['a', 'b']
+    assert parse_json('{"arguments": ["a", "b" ,\n],\n}', MODEL, opening='{') == {'arguments': ['a', 'b']}
+
+
+def test_surrounding_prose():
+    answer = 'Here are the arguments:\n["a", "b"]\nI hope this helps!'
+    assert parse_json(answer, MODEL) == ['a', 'b']
+    answer = 'Sure! {"arguments": ["a, b", "c"]} Let me know [if needed].'
+    assert argument_list(parse_json(answer, MODEL, opening='{')) == ['a, b', 'c']
+
+
+def test_all_defects_together():
+    answer = 'Result:\n```json\n[\n  "a",\n  "b",\n]\n```\nDone.'
+    assert parse_json(answer, MODEL) == ['a', 'b']
+
+
+@pytest.mark.parametrize('answer', [
+    '["a", "b"',
+    '```json\n["a", "b",\n```',
+    '{"arguments": ["a", "b"',
+    'Here are the arguments: ["a", "b',
+    'I could not find any argument.',
+])
+def test_truncated_answer_raises(answer):
+    with pytest.raises(ValueError):
+        parse_json(answer, MODEL, opening='{' if answer.startswith('{') else '[')
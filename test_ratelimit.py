@@ -0,0 +1,129 @@
+"""Tests of the rate limiting of the LLM calls, with local stand-ins for the
+chat model (no network access or API key is needed).
+
+Run from the top level directory with: python -m pytest test_ratelimit.py
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import sys
+import time
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline'))
+
+import hedging
+import llm
+import ratelimit
+from benchmark import FakeChatOpenAI
+
+
+@pytest.fixture(autouse=True)
+def estimates(monkeypatch):
+    # (!) tiktoken may need to download its vocabularies
+    monkeypatch.setattr(llm, 'token_counts',
+                        lambda texts, model: [len(text) // 4 + 1 for text in texts])
+
+
+def use_client(model, client):
+    llm.clients[(model, 0.0, None, None)] = client
+
+
+def test_more_async_calls_than_threads():
+    model = 'fake-async'
+    ratelimit.configure({model: {'concurrency': 8, 'max_concurrency': 8}})
+    client = FakeChatOpenAI(model)
+    client.latency = 0.01
+    use_client(model, client)
+    gateway = llm.Gateway(model, cache=False)
+
+    async def run():
+        # (!) the fake client answers in the default pool, like langchain
+        # does for models without a native async API
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=4))
+        calls = [gateway.ainvoke([HumanMessage(f"comment {i}")]) for i in range(64)]
+        return await asyncio.wait_for(asyncio.gather(*calls), timeout=30)
+
+    answers = asyncio.run(run())
+    assert len(answers) == 64
+    assert ratelimit.limiter(model).in_flight == 0
+
+
+class SlowFirstClient:
+    """Chat model whose first answer takes `slow` seconds, the others `fast`."""
+
+    def __init__(self, slow, fast, tokens):
+        self.delays = [slow]
+        self.fast = fast
+        self.tokens = tokens
+        self.sent = 0
+
+    def delay(self):
+        self.sent += 1
+        return self.delays.pop() if self.delays else self.fast
+
+    def answer(self):
+        return AIMessage(content="answer", usage_metadata={
+            'input_tokens': self.tokens, 'output_tokens': 0, 'total_tokens': self.tokens})
+
+    def invoke(self, messages, **kwargs):
+        time.sleep(self.delay())
+        return self.answer()
+
+    async def ainvoke(self, messages, **kwargs):
+        await asyncio.sleep(self.delay())
+        return self.answer()
+
+
+def hedged(model, limits, client):
+    """Gateway hedging every call to `model` after a few ms."""
+    ratelimit.configure({model: limits})
+    use_client(model, client)
+    hedging.latencies[model].extend([0.005] * hedging.MIN_SAMPLES)
+    return llm.Gateway(model, cache=False, hedge_fraction=1.0)
+
+
+def test_hedge_needs_a_free_slot():
+    client = SlowFirstClient(0.2, 0.01, 10)
+    gateway = hedged('fake-one-slot', {'concurrency': 1, 'max_concurrency': 1}, client)
+    assert gateway.invoke([HumanMessage("comment")]) == "answer"
+    client.delays = [0.2]
+    assert asyncio.run(gateway.ainvoke([HumanMessage("comment")])) == "answer"
+    assert client.sent == 2
+    assert hedging.counts[gateway.model][1] == 0
+    assert ratelimit.limiter(gateway.model).in_flight == 0
+
+
+def test_hedge_takes_a_slot_and_is_charged():
+    tokens = 1000
+    client = SlowFirstClient(0.3, 0.01, tokens)
+    # (!) a small budget, so that it refills by less than tokens / 10 here
+    limits = {'concurrency': 2, 'max_concurrency': 2, 'tpm': 10 * tokens}
+    gateway = hedged('fake-two-slots', limits, client)
+    bucket = ratelimit.limiter(gateway.model).tokens
+    assert gateway.invoke([HumanMessage("comment")]) == "answer"
+    assert client.sent == 2
+    # the slower request keeps its slot until it answers
+    assert ratelimit.limiter(gateway.model).in_flight == 1
+    time.sleep(0.4)
+    assert ratelimit.limiter(gateway.model).in_flight == 0
+    bucket.refill()
+    assert bucket.level < bucket.capacity - 1.5 * tokens
+
+
+def test_async_hedge_releases_the_cancelled_slot():
+    client = SlowFirstClient(0.3, 0.01, 10)
+    gateway = hedged('fake-async-hedge', {'concurrency': 2, 'max_concurrency': 2}, client)
+
+    async def run():
+        answer = await gateway.ainvoke([HumanMessage("comment")])
+        await asyncio.sleep(0)  # let the slower request handle its cancellation
+        return answer
+
+    assert asyncio.run(run()) == "answer"
+    assert client.sent == 2
+    assert ratelimit.limiter(gateway.model).in_flight == 0